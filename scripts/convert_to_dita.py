@@ -16,32 +16,58 @@ Key features:
 Usage:
     python convert_to_dita.py [--input-dir PATH] [--output-dir PATH]
     python convert_to_dita.py --inline-includes   # Inline mode (no warehouse topics)
-    python convert_to_dita.py --inline-includes --use-existing-images  # Keep existing images
+    python convert_to_dita.py --inline-includes --use-existing-images  # Keep the images directory
 """
 
 import os
 import posixpath
 import re
 import sys
+import shutil
+import shlex
+import subprocess
+import tempfile
 import argparse
 import uuid
 import base64
+import hashlib
+import json
+import importlib.util
+import multiprocessing
 import zlib
 import io
+import gzip
+import http.client
+import urllib.parse
 import urllib.request
 import urllib.error
 from pathlib import Path
-from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Tuple
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
 import html
+import random
+import threading
 import time
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import date
 
 # ============================================================================
 # Configuration
 # ============================================================================
 
+# Default Kroki server (ConversionConfig.kroki_urls); the public service is
+# https://kroki.io.
+KROKI_URL = "http://172.26.83.19:8888"
+
+# Image formats diagrams can be rendered to (ConversionConfig.diagram_format)
+DIAGRAM_FORMATS = ('png', 'svg')
+
+# Layout version of the archives written by --export-diagram-pack
+DIAGRAM_PACK_VERSION = 1
+
+
 @dataclass
 class ConversionConfig:
     """Configuration for the DITA conversion process."""
@@ -53,7 +79,29 @@ class ConversionConfig:
     images_dir: str = "images"        # Directory for downloaded images
     inline_includes: bool = False     # If True, inline include content instead of conref
     skip_diagrams: bool = False       # If True, skip downloading Mermaid diagrams (faster for testing)
-    use_existing_images: bool = False  # If True, keep existing images and only download missing ones
+    use_existing_images: bool = False  # If True, keep the images directory; diagrams still come from the render cache
+    optimize_images: bool = False     # If True, losslessly shrink every PNG in images/ after conversion
+    diagram_jobs: int = 4             # Concurrent Kroki requests while rendering diagrams (1 = serial)
+    diagram_adaptive: bool = True     # If True, treat diagram_jobs as a ceiling and adapt to Kroki's response (AIMD)
+    diagram_cache_dir: Optional[Path] = None  # Cross-run render cache (default: default_diagram_cache_dir())
+    diagram_cache_size: int = 512 * 1024 * 1024  # Byte cap on the render cache, LRU-evicted (0 = unbounded)
+    inline_cache_size: int = 4096     # Rendered inline fragments remembered per run, LRU-evicted (0 = off)
+    parse_cache: Optional[Path] = None  # Parsed-Markdown cache file reused across runs (None = off; see default_parse_cache_path())
+    shared_diagrams: bool = False     # If True, name diagram images by content so every inclusion shares one file
+    diagram_format: str = "png"       # Image format requested from Kroki: "png" or "svg"
+    diagram_retries: int = 6          # Attempts per diagram before it falls back to an -error.png placeholder
+    diagram_failure_budget: int = 10  # Distinct diagrams allowed to fail per run (renderer rejections excluded); once spent, the rest are not attempted
+    diagram_deadline: float = 0       # Seconds allowed for all diagram rendering in a run (0 = no limit)
+    diagram_report: Optional[Path] = None  # Per-diagram telemetry JSON (default: <output_dir>-diagrams.json beside it)
+    diagram_renderer: str = "kroki"   # Diagram backend: "kroki", "command" (diagram_command) or "stub" (placeholders)
+    diagram_command: str = ""         # Local render command for the "command" backend, e.g. "mmdc -i {input} -o {output}"
+    kroki_urls: List[str] = field(default_factory=lambda: [KROKI_URL])  # Kroki servers that render Mermaid diagrams
+    kroki_pool_size: int = 0          # Keep-alive connections kept open to each Kroki server (0 = one per diagram job)
+    kroki_connect_timeout: float = 10.0  # Seconds allowed to open a connection to Kroki
+    kroki_timeout: float = 60.0       # Seconds allowed for Kroki to answer one render request
+    kroki_post_threshold: int = 2048  # Request paths longer than this are sent as a POST instead of a GET
+    kroki_eject_seconds: float = 30.0  # How long a failing or slow Kroki server is left out before it is probed again
+    kroki_slow_seconds: float = 20.0  # Average render time above which a Kroki server is treated as unhealthy
 
     standalone_file: Optional[Path] = None  # If set, convert a single standalone markdown file
     single_task: bool = False         # If True, emit one task topic from standalone file (instead of splitting by H1)
@@ -263,7 +311,17 @@ def collapse_consecutive_notes(lines: List[str]) -> List[str]:
     return result
 
 
-def get_kroki_url(mermaid_code: str) -> str:
+def get_kroki_path(mermaid_code: str, fmt: str = 'png') -> str:
+    """Return the Kroki request path ('/mermaid/<fmt>/<payload>') for Mermaid code."""
+    code = mermaid_code.strip()
+
+    # Kroki uses deflate compression + base64
+    compressed = zlib.compress(code.encode('utf-8'), 9)
+    encoded = base64.urlsafe_b64encode(compressed).decode('ascii')
+    return f"/mermaid/{fmt}/{encoded}"
+
+
+def get_kroki_url(mermaid_code: str, base_url: str = KROKI_URL, fmt: str = 'png') -> str:
     """
     Generate a Kroki URL for Mermaid code.
 
@@ -272,84 +330,1141 @@ def get_kroki_url(mermaid_code: str) -> str:
     which is applied at the image-rendering layer and is more reliable than
     the Mermaid init theme directive.
     """
-    code = mermaid_code.strip()
+    return base_url.rstrip('/') + get_kroki_path(mermaid_code, fmt)
+
+
+class DiagramRejected(Exception):
+    """A renderer refused the diagram itself, so retrying cannot help."""
+
+
+class DiagramRenderer:
+    """Turns Mermaid source into image bytes; the batch phase's only view of a backend.
+
+    Implementations: KrokiBalancer (HTTP to one or more Kroki servers),
+    CommandRenderer (a local program such as the Mermaid CLI) and StubRenderer
+    (placeholder images, no I/O). ConversionConfig.diagram_renderer picks one
+    via make_diagram_renderer().
+
+    render() raises DiagramRejected for a bad diagram, urllib.error.HTTPError
+    or URLError for a Kroki failure, and anything else for a transient error
+    that download_mermaid_image() should retry.
+    """
+
+    timeout: float = 60.0  # Seconds one render may take
+
+    def render(self, mermaid_code: str, timeout: Optional[float] = None, fmt: str = 'png') -> bytes:
+        raise NotImplementedError
+
+    def close(self):
+        """Release whatever the renderer holds open between renders."""
+
+
+class KrokiClient(DiagramRenderer):
+    """HTTP/1.1 keep-alive client for Kroki, shared by every render worker.
+
+    A fresh urlopen() per diagram pays a TCP connect and teardown for each small
+    PNG. This keeps up to ``pool_size`` connections open and hands an idle one
+    to whichever worker asks next, so a run reuses a few connections for all of
+    its diagrams. Errors are raised as urllib.error.HTTPError / URLError, the
+    same types urlopen() raises, so the retry logic treats both paths alike.
+    """
+
+    USER_AGENT = 'DITA-Converter/1.0'
+
+    def __init__(self, base_url: str = KROKI_URL, pool_size: int = 4,
+                 connect_timeout: float = 10.0, timeout: float = 60.0,
+                 post_threshold: int = 2048):
+        parts = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url.rstrip('/')
+        self._host = parts.hostname
+        self._port = parts.port
+        self._prefix = parts.path.rstrip('/')
+        self._conn_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                            else http.client.HTTPConnection)
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.post_threshold = post_threshold
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+        self._idle = []
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+
+    def _connect(self) -> http.client.HTTPConnection:
+        conn = self._conn_class(self._host, self._port, timeout=self.connect_timeout)
+        conn.connect()
+        with self._lock:
+            self.connections_opened += 1
+        return conn
+
+    def render(self, mermaid_code: str, timeout: Optional[float] = None, fmt: str = 'png') -> bytes:
+        """Render Mermaid code to image bytes in ``fmt`` ('png' or 'svg').
+
+        Small diagrams go out as a GET with the source deflated into the path,
+        the form Kroki caches best. Past ``post_threshold`` that URL gets long
+        enough for proxies and servers to slow down on or reject, so the raw
+        source is sent as the body of a POST instead.
+        """
+        path = get_kroki_path(mermaid_code, fmt)
+        if len(path) <= self.post_threshold:
+            return self.get(path, timeout=timeout)
+        return self.post(f'/mermaid/{fmt}', mermaid_code.strip().encode('utf-8'), timeout=timeout)
+
+    def get(self, path: str, timeout: Optional[float] = None) -> bytes:
+        """GET ``path`` from the server and return the response body."""
+        return self._send('GET', path, None, {}, timeout)
+
+    def post(self, path: str, body: bytes, content_type: str = 'text/plain; charset=utf-8',
+             timeout: Optional[float] = None) -> bytes:
+        """POST ``body`` to ``path`` and return the response body."""
+        return self._send('POST', path, body, {'Content-Type': content_type}, timeout)
+
+    def _send(self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str],
+              timeout: Optional[float]) -> bytes:
+        url = self.base_url + path
+        headers = dict(headers, **{'User-Agent': self.USER_AGENT})
+        with self._slots:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            try:
+                if conn is None:
+                    conn = self._connect()
+                try:
+                    response = self._request(conn, method, self._prefix + path, body, headers, timeout)
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    if not reused:
+                        raise
+                    # The server dropped an idle keep-alive connection; that says
+                    # nothing about this request, so retry it once on a new one.
+                    conn.close()
+                    conn = self._connect()
+                    response = self._request(conn, method, self._prefix + path, body, headers, timeout)
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                if conn is not None:
+                    conn.close()
+                raise urllib.error.URLError(e)
+
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, None)
+        return data
+
+    def _request(self, conn, method: str, path: str, body: Optional[bytes],
+                 headers: Dict[str, str], timeout: Optional[float]):
+        conn.sock.settimeout(self.timeout if timeout is None else timeout)
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def parse_kroki_urls(value: str) -> List[str]:
+    """Split a comma- or whitespace-separated list of Kroki server URLs."""
+    return [url for url in re.split(r'[\s,]+', value) if url]
+
+
+class AdaptiveLimiter:
+    """Caps concurrent renders, adjusting the cap AIMD-style.
+
+    A fixed worker count either leaves a fast Kroki idle or piles requests
+    onto a slow one until they time out and retry. Instead the cap starts
+    low and grows while responses are healthy -- by one per success until the
+    first sign of trouble (slow start), then by about one per cap's worth of
+    successes -- and halves on a timeout, a retryable error or a slow render,
+    never going below ``minimum`` or above ``maximum``. Requests that were
+    already in flight when the cap was cut do not cut it again, so one
+    overloaded moment halves it once rather than once per casualty.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, initial: Optional[int] = None):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        start = initial if initial is not None else min(2, self.maximum)
+        self.limit = float(max(self.minimum, min(start, self.maximum)))
+        self.in_flight = 0
+        self._epoch = 0           # Bumped on every cut
+        self._slow_start = True
+        self._cond = threading.Condition()
+
+    def saturate(self):
+        """Open the cap to ``maximum`` at once, skipping slow start.
+
+        For a batch whose whole point is to keep every worker busy; congestion
+        still halves the cap as usual.
+        """
+        with self._cond:
+            self.limit = float(self.maximum)
+            self._slow_start = False
+            self._cond.notify_all()
+
+    def acquire(self) -> int:
+        """Block until a slot is free; returns a token to hand to release()."""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return self._epoch
+
+    def release(self, token: int, congested: bool):
+        """Free a slot and adjust the cap from the request's outcome."""
+        with self._cond:
+            self.in_flight -= 1
+            if congested:
+                if token == self._epoch:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self._epoch += 1
+                    self._slow_start = False
+            elif self._slow_start:
+                self.limit = min(float(self.maximum), self.limit + 1)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class _KrokiEndpoint:
+    """Load and health bookkeeping for one server behind a KrokiBalancer."""
+
+    def __init__(self, client: KrokiClient):
+        self.client = client
+        self.outstanding = 0      # Renders currently in flight
+        self.served = 0           # Renders started, used to rotate between equally loaded servers
+        self.latency = None       # Moving average of successful render times, in seconds
+        self.ejected_until = 0.0  # Clock time before which the server is not used
+        self.needs_probe = False  # Set on ejection; cleared by a passing health probe
+        self.probing = False
+
+
+class KrokiBalancer(DiagramRenderer):
+    """Spreads diagram renders over several Kroki servers.
+
+    Each render goes to the healthy server with the fewest requests in flight
+    (ties rotate), so a fast server naturally takes more of the work than a
+    slow one. A server that refuses connections, answers with a retryable
+    error, or whose average render time climbs past ``slow_seconds`` is
+    ejected for ``eject_seconds``; after that it has to pass a GET /health
+    probe before it is given renders again. If every server is ejected, the
+    one due back soonest is used anyway and the retry/budget logic in
+    download_mermaid_image() decides when to give up.
+
+    An optional AdaptiveLimiter caps how many renders are in flight across
+    all servers; timeouts, retryable errors and renders slower than
+    ``slow_seconds`` are reported to it as congestion.
+
+    Presents the same render()/timeout/close() surface as KrokiClient.
+    """
+
+    LATENCY_WEIGHT = 0.3  # Weight of the newest sample in the moving average
+
+    def __init__(self, urls: List[str], pool_size: int = 4, connect_timeout: float = 10.0,
+                 timeout: float = 60.0, post_threshold: int = 2048,
+                 eject_seconds: float = 30.0, slow_seconds: float = 20.0,
+                 limiter: Optional['AdaptiveLimiter'] = None, clock=time.monotonic):
+        if not urls:
+            raise ValueError("KrokiBalancer needs at least one server URL")
+        self.endpoints = [_KrokiEndpoint(KrokiClient(url, pool_size=pool_size,
+                                                     connect_timeout=connect_timeout,
+                                                     timeout=timeout,
+                                                     post_threshold=post_threshold))
+                          for url in urls]
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.eject_seconds = eject_seconds
+        self.slow_seconds = slow_seconds
+        self.limiter = limiter
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @property
+    def connections_opened(self) -> int:
+        return sum(e.client.connections_opened for e in self.endpoints)
+
+    def render(self, mermaid_code: str, timeout: Optional[float] = None, fmt: str = 'png') -> bytes:
+        """Render Mermaid code on the least busy healthy server."""
+        token = self.limiter.acquire() if self.limiter is not None else 0
+        congested = True
+        try:
+            endpoint = self._acquire()
+            start = self._clock()
+            try:
+                data = endpoint.client.render(mermaid_code, timeout=timeout, fmt=fmt)
+            except urllib.error.HTTPError as e:
+                # A 400 means the diagram is bad, not the server
+                if is_retryable_status(e.code):
+                    self._eject(endpoint, f"HTTP {e.code}")
+                else:
+                    congested = False
+                raise
+            except urllib.error.URLError as e:
+                self._eject(endpoint, str(e.reason))
+                raise
+            finally:
+                with self._lock:
+                    endpoint.outstanding -= 1
+            elapsed = self._clock() - start
+            congested = elapsed > self.slow_seconds
+            self._record_latency(endpoint, elapsed)
+            return data
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(token, congested)
+
+    def _acquire(self) -> _KrokiEndpoint:
+        while True:
+            with self._lock:
+                now = self._clock()
+                probe = next((e for e in self.endpoints
+                              if e.needs_probe and not e.probing and e.ejected_until <= now), None)
+                if probe is not None:
+                    probe.probing = True
+                else:
+                    healthy = [e for e in self.endpoints if not e.needs_probe]
+                    if not healthy:
+                        healthy = [min(self.endpoints, key=lambda e: e.ejected_until)]
+                    chosen = min(healthy, key=lambda e: (e.outstanding, e.served))
+                    chosen.outstanding += 1
+                    chosen.served += 1
+                    return chosen
+            # Probe outside the lock so other workers keep rendering meanwhile
+            self._probe(probe)
+
+    def _probe(self, endpoint: _KrokiEndpoint):
+        try:
+            endpoint.client.get('/health', timeout=self.connect_timeout)
+            healthy = True
+        except urllib.error.URLError:
+            healthy = False
+        with self._lock:
+            endpoint.probing = False
+            if healthy:
+                endpoint.needs_probe = False
+                endpoint.latency = None
+            else:
+                endpoint.ejected_until = self._clock() + self.eject_seconds
+
+    def _eject(self, endpoint: _KrokiEndpoint, reason: str):
+        with self._lock:
+            announce = not endpoint.needs_probe
+            endpoint.needs_probe = True
+            endpoint.latency = None
+            endpoint.ejected_until = self._clock() + self.eject_seconds
+        if announce and len(self.endpoints) > 1:
+            print(f"    Warning: Taking Kroki server {endpoint.client.base_url} out of rotation "
+                  f"for {self.eject_seconds:g}s: {reason}")
+
+    def _record_latency(self, endpoint: _KrokiEndpoint, elapsed: float):
+        with self._lock:
+            # A render that succeeds is as good as a passing probe
+            endpoint.needs_probe = False
+            if endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency += self.LATENCY_WEIGHT * (elapsed - endpoint.latency)
+            average = endpoint.latency
+        if average > self.slow_seconds:
+            self._eject(endpoint, f"averaging {average:.1f}s per diagram")
+
+    def close(self):
+        """Close every idle connection to every server."""
+        for endpoint in self.endpoints:
+            endpoint.client.close()
+
+
+def normalize_mermaid(mermaid_code: str) -> str:
+    """Return the whitespace-normalized form of a Mermaid source.
+
+    Indentation, trailing spaces, runs of blanks and empty lines carry no meaning
+    in Mermaid, so two diagrams that differ only in those render identically and
+    should share one cache entry.
+    """
+    lines = (re.sub(r'\s+', ' ', line.strip()) for line in mermaid_code.split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def diagram_hash(mermaid_code: str) -> str:
+    """Content hash that keys a rendered diagram (SHA-256 of the normalized source)."""
+    return hashlib.sha256(normalize_mermaid(mermaid_code).encode('utf-8')).hexdigest()
+
+
+def default_diagram_cache_dir() -> Path:
+    """Per-user render cache location, honouring XDG_CACHE_HOME.
+
+    It lives outside the output directory on purpose: a normal build wipes
+    the output directory, and the cache has to survive that for a clean build
+    to cost local copies rather than a Kroki round-trip per diagram.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'quickstart-guides' / 'diagrams'
+
+
+def default_parse_cache_path() -> Path:
+    """Per-user parse cache file, next to the diagram render cache."""
+    return default_diagram_cache_dir().parent / 'parsed.json.gz'
+
+
+class DiagramCache:
+    """Content-addressed store of rendered diagrams, one '<hash>.<format>' per diagram.
+
+    Keyed by diagram_hash(), so a hit is exact: editing a diagram changes its key
+    and misses, while the same diagram reached from several guides or several
+    runs is rendered once. Writes go through a temporary file and os.replace, so
+    concurrent workers never observe a half-written entry.
+
+    A hit refreshes the entry's mtime, which makes mtime the recency order that
+    prune() evicts by once the cache outgrows ``max_bytes``. Entries this
+    instance has read or written are never evicted by it, so a run that needs
+    more than ``max_bytes`` keeps everything it rendered until it is done.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._used = set()   # Paths this instance has handed out or stored
+
+    def path(self, key: str, fmt: str = 'png') -> Path:
+        return self.root / f'{key}.{fmt}'
+
+    def get(self, key: str, fmt: str = 'png') -> Optional[Path]:
+        """Return the cached ``fmt`` render for ``key``, or None on a miss."""
+        path = self.path(key, fmt)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        self._used.add(path)
+        return path
+
+    def put(self, key: str, data: bytes, fmt: str = 'png') -> Path:
+        """Store rendered bytes under ``key`` and return the entry's path."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.path(key, fmt)
+        tmp = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        self._used.add(path)
+        return path
+
+    def prune(self) -> int:
+        """Evict least recently used entries until the cache fits in ``max_bytes``.
+
+        Returns the number of entries removed. Entries this run has used are
+        kept even when that leaves the cache over its cap, since the run may
+        still copy them out (into a diagram pack, say).
+        """
+        if self.max_bytes <= 0 or not self.root.is_dir():
+            return 0
+        entries = []
+        total = 0
+        for path in self.root.iterdir():
+            if path.suffix.lstrip('.') not in DIAGRAM_FORMATS:
+                continue  # e.g. another worker's in-progress .tmp file
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            total += st.st_size
+            if path not in self._used:
+                entries.append((st.st_mtime, st.st_size, path))
+        removed = 0
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+def shared_diagram_filename(mermaid_code: str, fmt: str = 'png') -> str:
+    """Content-derived image name used by --shared-diagrams.
+
+    Every inclusion of the same diagram maps to the same file, so an include
+    inlined into twenty guides ships one image instead of twenty copies.
+    """
+    return f"diagram-{diagram_hash(mermaid_code)[:16]}.{fmt}"
+
+
+# 4xx statuses worth retrying: timeouts and rate limiting are transient. Every
+# other client error (a Mermaid syntax error is a 400) fails the same way on
+# every attempt, so retrying it only stalls the build.
+RETRYABLE_CLIENT_STATUSES = {408, 425, 429}
+
+
+def is_retryable_status(status: int) -> bool:
+    """True if an HTTP error status from Kroki may succeed on a later attempt."""
+    return status >= 500 or status in RETRYABLE_CLIENT_STATUSES
+
+
+@dataclass
+class RetryPolicy:
+    """Per-diagram retry schedule: capped exponential backoff with full jitter."""
+    max_attempts: int = 6
+    base_delay: float = 1.0   # Upper bound of the first wait, in seconds
+    max_delay: float = 30.0   # Cap on any single wait
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after failed attempt number ``attempt`` (1-based).
+
+        Jitter spreads the retries of concurrent workers out, so a Kroki that
+        hiccups is not hit by every worker again at the same instant.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class RenderBudget:
+    """Failure budget, circuit breaker and deadline shared by every render in a run.
+
+    Without these one unreachable Kroki host costs the full retry schedule for
+    every diagram in turn. The budget caps how many distinct diagrams may fail
+    before the rest are not attempted; the breaker opens after ``breaker_threshold``
+    consecutive request errors across all workers and only lets a trial request
+    through once ``breaker_cooldown`` has passed; the deadline bounds the whole
+    diagram phase. Anything refused here degrades to its -error.png placeholder.
+
+    Workers wait while the breaker is open rather than giving up, so a short
+    outage costs time, not diagrams; only after ``breaker_trials`` trial
+    requests in a row have failed is the renderer written off for the run.
+    Neither the breaker nor the deadline counts against the failure budget.
+
+    A diagram the renderer rejects (a Mermaid syntax error) is the diagram's
+    fault, not the renderer's: it is remembered so its other inclusions fail
+    without a request, and it is not counted against the budget.
+    """
+
+    def __init__(self, max_failures: int = 10, deadline: float = 0,
+                 breaker_threshold: int = 5, breaker_cooldown: float = 30.0,
+                 breaker_trials: int = 3, clock=time.monotonic):
+        self.max_failures = max_failures
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_trials = breaker_trials
+        self._clock = clock
+        self._deadline_at = clock() + deadline if deadline > 0 else None
+        self._lock = threading.Lock()
+        self._failed = set()     # Keys of diagrams counted against the budget
+        self._rejected = {}      # Key -> why the renderer rejected it
+        self._consecutive_errors = 0
+        self._opened_at = None
+        self._trial = False          # A half-open trial request is in flight
+        self._failed_trials = 0      # Trial requests in a row that have failed
+
+    # While the breaker is open, how long a waiting worker sleeps before asking
+    # again: short, so a successful trial request releases everyone promptly
+    BREAKER_POLL = 0.5
+
+    @property
+    def failures(self) -> int:
+        """Distinct diagrams that have failed for reasons other than rejection."""
+        return len(self._failed)
+
+    def admit(self) -> Tuple[str, float]:
+        """Whether a request may be made now, as (refusal, wait).
+
+        ('', 0) means go ahead. A refusal with no wait means no further request
+        may be made in this run. While the breaker is open the refusal comes
+        with the seconds to sleep before asking again.
+        """
+        with self._lock:
+            if len(self._failed) >= self.max_failures:
+                return f'failure budget of {self.max_failures} diagrams spent', 0.0
+            if self._deadline_at is not None and self._clock() >= self._deadline_at:
+                return 'diagram deadline reached', 0.0
+            if self._failed_trials >= self.breaker_trials:
+                return f'renderer unreachable after {self._failed_trials} trial requests', 0.0
+            if self._opened_at is not None:
+                left = self.breaker_cooldown - (self._clock() - self._opened_at)
+                if left > 0:
+                    return 'circuit breaker open', self.clamp(min(left, self.BREAKER_POLL))
+                # Half-open: admit a trial request. Re-arm the cooldown so only
+                # this one goes through; its outcome closes or re-opens the breaker.
+                self._opened_at = self._clock()
+                self._trial = True
+            return '', 0.0
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline, or None when there is none."""
+        if self._deadline_at is None:
+            return None
+        return max(0.0, self._deadline_at - self._clock())
+
+    def clamp(self, seconds: float) -> float:
+        """Limit a timeout or wait so it never runs past the deadline."""
+        left = self.remaining()
+        return seconds if left is None else min(seconds, left)
+
+    def record_success(self):
+        """Note that the renderer answered; closes the breaker."""
+        with self._lock:
+            self._consecutive_errors = 0
+            self._opened_at = None
+            self._trial = False
+            self._failed_trials = 0
+
+    def record_error(self):
+        """Count one failed request; open the breaker once enough pile up."""
+        with self._lock:
+            self._consecutive_errors += 1
+            if self._trial:
+                self._trial = False
+                self._failed_trials += 1
+            if self._consecutive_errors >= self.breaker_threshold:
+                self._opened_at = self._clock()
+
+    def record_failure(self, key: str):
+        """Count the diagram ``key`` that ended as a placeholder against the budget.
+
+        Each diagram counts once however many inclusions of it fail, and a
+        rejected one not at all.
+        """
+        with self._lock:
+            if key not in self._rejected:
+                self._failed.add(key)
+
+    def record_rejection(self, key: str, reason: str):
+        """Remember that the renderer refused the diagram ``key`` outright."""
+        with self._lock:
+            self._rejected[key] = reason
+        # A rejection is still an answer: the renderer is up
+        self.record_success()
+
+    def rejection(self, key: str) -> str:
+        """Why the renderer rejected the diagram ``key`` earlier, or '' if it has not."""
+        with self._lock:
+            return self._rejected.get(key, '')
+
+
+@dataclass
+class DiagramJob:
+    """A Mermaid diagram recorded during topic generation, rendered later in batch."""
+    source: str       # Mermaid code as authored
+    context: str      # Source context of the file it came from (e.g. 'rhel-iscsi-quickstart')
+    number: int       # Diagram number within that file
+    target: Path      # Where the rendered image is written
+    source_file: str = ""  # Repo-relative Markdown file it was reached from
+
+    @property
+    def filename(self) -> str:
+        return self.target.name
 
-    # Kroki uses deflate compression + base64
-    compressed = zlib.compress(code.encode('utf-8'), 9)
-    encoded = base64.urlsafe_b64encode(compressed).decode('ascii')
-    return f"http://172.26.83.19:8888/mermaid/png/{encoded}"
-    #return f"https://kroki.io/mermaid/png/{encoded}"
 
+@dataclass
+class DiagramRecord:
+    """Telemetry for one rendered diagram; one entry in the diagram report."""
+    source_file: str         # Repo-relative Markdown file the diagram was reached from
+    number: int              # Diagram number within that file
+    content_hash: str        # diagram_hash() of the source
+    filename: str            # Image the topics reference (the -error name if rendering failed)
+    cache: str = "miss"      # 'hit', 'miss', 'existing' (file already in place) or 'shared' (coalesced)
+    size_bytes: int = 0      # Size of the image written
+    seconds: float = 0.0     # Wall time for this diagram, retries and backoff included
+    retries: int = 0         # Attempts beyond the first
+    ok: bool = True
+
+
+def write_diagram_report(path: Path, records: List[DiagramRecord], renderer: str, fmt: str):
+    """Write the per-diagram render telemetry as JSON, slowest diagrams first."""
+    diagrams = sorted(records, key=lambda r: r.seconds, reverse=True)
+    report = {
+        'generated': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'renderer': renderer,
+        'format': fmt,
+        'totals': {
+            'diagrams': len(records),
+            'cache_hits': sum(1 for r in records if r.cache in ('hit', 'existing')),
+            'rendered': sum(1 for r in records if r.cache == 'miss' and r.ok),
+            'shared': sum(1 for r in records if r.cache == 'shared'),
+            'failed': sum(1 for r in records if not r.ok),
+            'retries': sum(r.retries for r in records),
+            'bytes': sum(r.size_bytes for r in records),
+            'seconds': round(sum(r.seconds for r in records), 3),
+        },
+        'diagrams': [asdict(r) for r in diagrams],
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=2) + '\n', encoding='utf-8')
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _png_chunks(data: bytes):
+    """Yield (type, payload) for each chunk of a PNG file."""
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        yield data[pos + 4:pos + 8], data[pos + 8:pos + 8 + length]
+        pos += 12 + length  # length, type, payload, CRC
+
+
+def png_is_opaque(data: bytes) -> bool:
+    """True if a PNG's header rules out transparency, without decoding pixels.
 
-def download_mermaid_image(mermaid_code: str, images_dir: Path, source_context: str, diagram_num: int) -> str:
+    Color types 4 and 6 carry an alpha channel; the other types can only be
+    transparent through a tRNS chunk, which has to precede the first IDAT.
+    """
+    if not data.startswith(PNG_SIGNATURE) or data[12:16] != b'IHDR' or len(data) < 26:
+        return False
+    if data[25] in (4, 6):
+        return False
+    for chunk_type, _ in _png_chunks(data):
+        if chunk_type == b'tRNS':
+            return False
+        if chunk_type in (b'IDAT', b'IEND'):
+            return True
+    return False
+
+
+def flatten_png(data: bytes) -> bytes:
+    """Composite a PNG onto white so its transparent areas don't show up dark.
+
+    Images that are already opaque -- by their header, or because every alpha
+    value is 255 -- are returned byte for byte, skipping the re-encode. The
+    composite uses NumPy when it is installed and Pillow's paste otherwise;
+    without Pillow the image is returned as is.
+    """
+    if png_is_opaque(data):
+        return data
+    try:
+        from PIL import Image as _PILImage
+    except ImportError:
+        return data
+    img = _PILImage.open(io.BytesIO(data)).convert("RGBA")
+    alpha = img.getchannel("A")
+    if alpha.getextrema()[0] == 255:
+        return data
+    try:
+        import numpy as np
+    except ImportError:
+        bg = _PILImage.new("RGBA", img.size, (255, 255, 255, 255))
+        bg.paste(img, mask=alpha)
+        flat = bg.convert("RGB")
+    else:
+        rgba = np.asarray(img, dtype=np.uint32)
+        rgb, a = rgba[..., :3], rgba[..., 3:]
+        # rgb * a/255 + white * (1 - a/255), rounded to nearest
+        flat = _PILImage.fromarray((255 - ((255 - rgb) * a + 127) // 255).astype(np.uint8), "RGB")
+    buf = io.BytesIO()
+    flat.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _png_chunk(chunk_type: bytes, payload: bytes) -> bytes:
+    return (len(payload).to_bytes(4, 'big') + chunk_type + payload
+            + zlib.crc32(chunk_type + payload).to_bytes(4, 'big'))
+
+
+def recompress_png(data: bytes) -> bytes:
+    """Re-deflate a PNG's image data at the smallest zlib setting.
+
+    Tries level 9 with the default, filtered and run-length strategies and
+    keeps whichever is smallest; pixels and every other chunk are untouched.
+    Returns ``data`` itself when nothing beats it.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks = list(_png_chunks(data))
+    idat = b''.join(payload for kind, payload in chunks if kind == b'IDAT')
+    try:
+        raw = zlib.decompress(idat)
+    except zlib.error:
+        return data
+    best = idat
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_RLE):
+        deflate = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidate = deflate.compress(raw) + deflate.flush()
+        if len(candidate) < len(best):
+            best = candidate
+    if best is idat:
+        return data
+    out = [PNG_SIGNATURE]
+    wrote_idat = False
+    for kind, payload in chunks:
+        if kind != b'IDAT':
+            out.append(_png_chunk(kind, payload))
+        elif not wrote_idat:
+            out.append(_png_chunk(b'IDAT', best))
+            wrote_idat = True
+    return b''.join(out)
+
+
+def palettize_png(data: bytes) -> Optional[bytes]:
+    """Re-encode a flat-colour RGB(A) PNG as an indexed one, if that is lossless.
+
+    Diagrams and UI screenshots often use a few dozen colours stored as 3-4
+    bytes per pixel; with 256 or fewer, a palette stores them in one. The
+    result is checked pixel for pixel against the original. Returns None when
+    Pillow is missing or the image does not qualify.
     """
-    Download a Mermaid diagram as PNG from Kroki and save locally.
+    try:
+        from PIL import Image as _PILImage
+    except ImportError:
+        return None
+    img = _PILImage.open(io.BytesIO(data))
+    if img.mode not in ('RGB', 'RGBA'):
+        return None
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    method = _PILImage.Quantize.FASTOCTREE if img.mode == 'RGBA' else _PILImage.Quantize.MEDIANCUT
+    indexed = img.quantize(colors=len(colors), method=method)
+    if indexed.convert(img.mode).tobytes() != img.tobytes():
+        return None
+    buf = io.BytesIO()
+    indexed.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def optimize_png(data: bytes) -> bytes:
+    """Smallest lossless encoding of a PNG: palettized and/or recompressed."""
+    candidates = [data, recompress_png(data)]
+    indexed = palettize_png(data)
+    if indexed is not None:
+        candidates.append(recompress_png(indexed))
+    return min(candidates, key=len)
+
+
+def _optimize_png_file(path: Path) -> Tuple[int, int]:
+    """Optimize one PNG in place; returns its size before and after."""
+    data = path.read_bytes()
+    try:
+        smaller = optimize_png(data)
+    except Exception:
+        # An image the decoder chokes on is left exactly as it was
+        return len(data), len(data)
+    if len(smaller) < len(data):
+        tmp = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+        tmp.write_bytes(smaller)
+        os.replace(tmp, path)
+    return len(data), min(len(data), len(smaller))
+
+
+def optimize_images(images_dir: Path, jobs: Optional[int] = None) -> Tuple[int, int, int]:
+    """Losslessly shrink every PNG under ``images_dir`` across a process pool.
+
+    Covers rendered diagrams and copied screenshots alike. Returns
+    (files shrunk, total bytes before, total bytes after).
+    """
+    paths = sorted(images_dir.rglob('*.png')) if images_dir.is_dir() else []
+    if not paths:
+        return 0, 0, 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        sizes = list(pool.map(_optimize_png_file, paths, chunksize=8))
+    shrunk = sum(1 for before, after in sizes if after < before)
+    return shrunk, sum(b for b, _ in sizes), sum(a for _, a in sizes)
+
+
+class StubRenderer(DiagramRenderer):
+    """Answers every render with a fixed placeholder image, without any I/O.
+
+    For exercising the diagram pipeline -- naming, caching, batching, the
+    href patching -- where no renderer is available.
+    """
+
+    PNG = (PNG_SIGNATURE
+           + _png_chunk(b'IHDR', (1).to_bytes(4, 'big') * 2 + bytes([8, 2, 0, 0, 0]))
+           + _png_chunk(b'IDAT', zlib.compress(b'\x00\xff\xff\xff'))
+           + _png_chunk(b'IEND', b''))
+    SVG = b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"/>'
+
+    def __init__(self):
+        self.renders = 0
+
+    def render(self, mermaid_code: str, timeout: Optional[float] = None, fmt: str = 'png') -> bytes:
+        self.renders += 1
+        return self.SVG if fmt == 'svg' else self.PNG
+
+
+class CommandRenderer(DiagramRenderer):
+    """Renders each diagram by running a local program, e.g. the Mermaid CLI.
+
+    ``command`` is split like a shell command line; in each argument
+    ``{input}`` becomes a file holding the diagram source, ``{output}`` the
+    path the program must write the image to, and ``{format}`` 'png' or
+    'svg'. A non-zero exit is taken as the diagram's fault.
+    """
+
+    def __init__(self, command: str, timeout: float = 60.0):
+        self.command = shlex.split(command)
+        if not self.command:
+            raise ValueError("CommandRenderer needs a command to run")
+        self.timeout = timeout
+
+    def render(self, mermaid_code: str, timeout: Optional[float] = None, fmt: str = 'png') -> bytes:
+        with tempfile.TemporaryDirectory(prefix='mermaid-') as tmp:
+            source = Path(tmp) / 'diagram.mmd'
+            output = Path(tmp) / f'diagram.{fmt}'
+            source.write_text(mermaid_code.strip() + '\n', encoding='utf-8')
+            args = [arg.replace('{input}', str(source)).replace('{output}', str(output))
+                    .replace('{format}', fmt) for arg in self.command]
+            result = subprocess.run(args, capture_output=True, text=True,
+                                    timeout=self.timeout if timeout is None else timeout)
+            if result.returncode != 0 or not output.is_file():
+                detail = (result.stderr.strip().splitlines() or ['no output'])[-1]
+                raise DiagramRejected(f"{args[0]} exited with status {result.returncode}: {detail}")
+            return output.read_bytes()
+
+
+DIAGRAM_RENDERERS = ('kroki', 'command', 'stub')
+
+
+def make_diagram_renderer(config: ConversionConfig) -> DiagramRenderer:
+    """Build the renderer ConversionConfig.diagram_renderer names."""
+    if config.diagram_renderer == 'stub':
+        return StubRenderer()
+    if config.diagram_renderer == 'command':
+        return CommandRenderer(config.diagram_command, timeout=config.kroki_timeout)
+    if config.diagram_renderer != 'kroki':
+        raise ValueError(f"Unknown diagram renderer: {config.diagram_renderer}")
+    renderer = KrokiBalancer(config.kroki_urls,
+                             pool_size=config.kroki_pool_size or config.diagram_jobs,
+                             connect_timeout=config.kroki_connect_timeout,
+                             timeout=config.kroki_timeout,
+                             post_threshold=config.kroki_post_threshold,
+                             eject_seconds=config.kroki_eject_seconds,
+                             slow_seconds=config.kroki_slow_seconds)
+    if config.diagram_adaptive:
+        # diagram_jobs is the ceiling; the limiter finds the level below it
+        # that Kroki can actually sustain
+        renderer.limiter = AdaptiveLimiter(maximum=config.diagram_jobs)
+    return renderer
+
+
+class _FlightCall:
+    """One in-progress call inside a SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one.
+
+    The first caller for a key runs the function; callers arriving while it
+    is still running wait for it and get the same result (or exception)
+    instead of repeating the work. Nothing is remembered once the call
+    returns -- persistence is DiagramCache's job.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _FlightCall] = {}
+        self.coalesced = 0  # Callers that shared another caller's result
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+def download_mermaid_image(mermaid_code: str, images_dir: Path, source_context: str, diagram_num: int,
+                           cache: Optional[DiagramCache] = None, filename: Optional[str] = None,
+                           policy: Optional[RetryPolicy] = None,
+                           budget: Optional[RenderBudget] = None,
+                           client: Optional[DiagramRenderer] = None,
+                           flight: Optional[SingleFlight] = None,
+                           flatten: Optional[Callable[[bytes], bytes]] = None,
+                           fmt: str = 'png',
+                           record: Optional[DiagramRecord] = None) -> str:
+    """
+    Download a Mermaid diagram as PNG (or SVG) from Kroki and save locally.
 
     Args:
         mermaid_code: The Mermaid diagram code
         images_dir: Directory to save images
         source_context: Human-readable source context (e.g., "rhel-nvme-tcp-quickstart")
         diagram_num: Diagram number within the source file
+        cache: Optional content-addressed render cache. A hit is copied into
+               images_dir without contacting Kroki; without a cache, an existing
+               file of the right name is trusted as before.
+        filename: Overrides the per-source name, e.g. with shared_diagram_filename().
+        policy: Retry schedule (default: RetryPolicy()). Client errors other than
+                timeouts and rate limiting fail immediately.
+        budget: Run-wide RenderBudget consulted before every request.
+        client: DiagramRenderer to render through (e.g. a pooled KrokiClient).
+                Without one, each attempt is a one-off urlopen() against the
+                default Kroki server.
+        flight: SingleFlight shared by concurrent workers. A diagram whose
+                source is already being rendered for another file waits for
+                that render instead of sending its own.
+        flatten: Post-processing applied to each PNG download before it is
+                 cached (default: flatten_png, on the calling thread).
+        fmt: Image format to request, 'png' or 'svg'. SVGs are vector and
+             already have no background to flatten, so they are written as-is.
+        record: DiagramRecord to fill in with how the image was obtained.
 
     Returns the relative path to the saved image file.
-    Filename format: {source_context}-diagram-{num}.png
+    Filename format: {source_context}-diagram-{num}.{fmt}
     Filename is stable even if diagram content changes.
+    On failure, the same name with an '-error' suffix is returned instead.
     """
     code = mermaid_code.strip()
 
     # Filename based only on source file and diagram number (stable across content edits)
-    filename = f"{source_context}-diagram-{diagram_num:02d}.png"
+    if filename is None:
+        filename = f"{source_context}-diagram-{diagram_num:02d}.{fmt}"
     filepath = images_dir / filename
+    stem, ext = os.path.splitext(filename)
+    error_filename = f"{stem}-error{ext}"
 
-    # Check if already downloaded (cache)
-    if filepath.exists():
-        return filename
+    record = record or DiagramRecord(source_file='', number=diagram_num,
+                                     content_hash=diagram_hash(code), filename=filename)
 
-    # Generate Kroki URL
-    url = get_kroki_url(code)
+    if filename == shared_diagram_filename(code, fmt) and filepath.exists():
+        # A content-named file can only ever hold this diagram
+        record.cache, record.size_bytes = 'existing', filepath.stat().st_size
+        return filename
+    if cache is not None:
+        # The cache is keyed by content, so an existing file under this name is
+        # not proof of anything -- it may be the render of an earlier revision.
+        cached = cache.get(diagram_hash(code), fmt)
+        if cached is not None:
+            shutil.copyfile(cached, filepath)
+            record.cache, record.size_bytes = 'hit', filepath.stat().st_size
+            return filename
+    elif filepath.exists():
+        record.cache, record.size_bytes = 'existing', filepath.stat().st_size
+        return filename
 
-    max_retries = 20
-    for attempt in range(1, max_retries + 1):
+    key = f'{diagram_hash(code)}.{fmt}'
+    rejected = budget.rejection(key) if budget is not None else ''
+    if rejected:
+        print(f"    Warning: Not rendering {filename}: already rejected ({rejected})")
+        return error_filename
+
+    def fetch() -> Optional[bytes]:
+        record.cache = 'miss'
+        return _fetch_diagram(code, filename, cache, policy or RetryPolicy(), budget, client,
+                              (flatten or flatten_png) if fmt == 'png' else None, fmt, record)
+
+    # Until fetch() runs, assume another worker's identical render is being shared
+    record.cache = 'shared'
+    content = flight.do(key, fetch) if flight is not None else fetch()
+    if content is None:
+        return error_filename
+
+    filepath.write_bytes(content)
+    record.size_bytes = len(content)
+    print(f"    Downloaded: {filename}")
+    return filename
+
+
+def _fetch_diagram(code: str, filename: str, cache: Optional[DiagramCache], policy: RetryPolicy,
+                   budget: Optional[RenderBudget], client: Optional[DiagramRenderer],
+                   flatten: Optional[Callable[[bytes], bytes]], fmt: str,
+                   record: DiagramRecord) -> Optional[bytes]:
+    """Render ``code`` with retries; returns the finished image, or None on failure.
+
+    Only a diagram that fails every attempt is counted against the budget; one
+    the budget refuses, or the renderer rejects, is not.
+    """
+    url = get_kroki_url(code, fmt=fmt)
+    key = f'{diagram_hash(code)}.{fmt}'
+
+    for attempt in range(1, policy.max_attempts + 1):
+        record.retries = attempt - 1
+        refusal, waited = '', False
+        while budget is not None:
+            refusal, wait = budget.admit()
+            if not wait:
+                break
+            if not waited:
+                print(f"    Waiting for the circuit breaker to render {filename}...")
+                waited = True
+            time.sleep(wait)
+        if refusal:
+            print(f"    Warning: Not rendering {filename}: {refusal}")
+            return None
+        timeout = client.timeout if client is not None else 60
+        if budget is not None:
+            timeout = budget.clamp(timeout)
         try:
-            req = urllib.request.Request(url, headers={'User-Agent': 'DITA-Converter/1.0'}, method='GET')
-            with urllib.request.urlopen(req, timeout=60) as response:
-                png_content = response.read()
-
-            try:
-                from PIL import Image as _PILImage
-                img = _PILImage.open(io.BytesIO(png_content)).convert("RGBA")
-                bg = _PILImage.new("RGBA", img.size, (255, 255, 255, 255))
-                bg.paste(img, mask=img.split()[3])
-                buf = io.BytesIO()
-                bg.convert("RGB").save(buf, format="PNG")
-                png_content = buf.getvalue()
-            except ImportError:
-                pass
-
-            filepath.write_bytes(png_content)
-            print(f"    Downloaded: {filename}")
-            return filename
+            if client is not None:
+                content = client.render(code, timeout=timeout, fmt=fmt)
+            else:
+                req = urllib.request.Request(url, headers={'User-Agent': 'DITA-Converter/1.0'}, method='GET')
+                with urllib.request.urlopen(req, timeout=timeout) as response:
+                    content = response.read()
+
+            if flatten is not None:
+                content = flatten(content)
+            if cache is not None:
+                cache.put(diagram_hash(code), content, fmt)
+            if budget is not None:
+                budget.record_success()
+            return content
 
+        except DiagramRejected as e:
+            print(f"    Warning: Renderer rejected {filename} ({e}); not retrying")
+            if budget is not None:
+                budget.record_rejection(key, str(e))
+            break
+        except urllib.error.HTTPError as e:
+            if not is_retryable_status(e.code):
+                # The diagram itself is bad; it will fail the same way every time
+                print(f"    Warning: Kroki rejected {filename} (HTTP {e.code}); not retrying")
+                if budget is not None:
+                    budget.record_rejection(key, f'HTTP {e.code}')
+                break
+            error = e
+            if budget is not None:
+                budget.record_error()
         except urllib.error.URLError as e:
             print(f"    URLError: {e}")
-            if attempt < max_retries:
-                print(f"    Retry {attempt}/{max_retries - 1}: {e}")
-                print("    Waiting 5 seconds before retrying...")
-                time.sleep(5)
-            else:
-                print(f"    Warning: Failed to download diagram after {max_retries} attempts: {e}")
-                return f"{source_context}-diagram-{diagram_num:02d}-error.png"
+            error = e
+            if budget is not None:
+                budget.record_error()
         except Exception as e:
             print(f"    Error: {e}")
-            if attempt < max_retries:
-                print(f"    Retry {attempt}/{max_retries - 1}: {e}")
-                print("    Waiting 5 seconds before retrying...")
-                time.sleep(5)
-            else:
-                print(f"    Warning: Error processing diagram after {max_retries} attempts: {e}")
-                return f"{source_context}-diagram-{diagram_num:02d}-error.png"
+            error = e
+
+        if attempt < policy.max_attempts:
+            wait = policy.delay(attempt)
+            if budget is not None:
+                wait = budget.clamp(wait)
+            print(f"    Retry {attempt}/{policy.max_attempts - 1}: {error}")
+            print(f"    Waiting {wait:.1f} seconds before retrying...")
+            time.sleep(wait)
+        else:
+            print(f"    Warning: Failed to download diagram after {policy.max_attempts} attempts: {error}")
+            if budget is not None:
+                budget.record_failure(key)
 
-    return f"{source_context}-diagram-{diagram_num:02d}-error.png"
+    return None
 
 
 # ============================================================================
@@ -380,23 +1495,220 @@ class MarkdownElement:
     children: List['MarkdownElement'] = field(default_factory=list)
 
 
+# Line kinds assigned by MarkdownParser._classify()
+LINE_BLANK = 'blank'
+LINE_FENCE = 'fence'        # ``` at any indent
+LINE_HEADING = 'heading'
+LINE_HASH = 'hash'          # '#' at the margin that is not a heading
+LINE_QUOTE = 'quote'
+LINE_TABLE = 'table'
+LINE_HR = 'hr'
+LINE_BULLET = 'bullet'
+LINE_ORDERED = 'ordered'
+LINE_IMAGE = 'image'
+LINE_TEXT = 'text'
+
+LIST_ITEM_KINDS = frozenset((LINE_BULLET, LINE_ORDERED))
+# Indented lines of these kinds continue the list item above them
+LIST_CONTINUATION_KINDS = frozenset((LINE_TEXT, LINE_IMAGE))
+# Lines that extend a paragraph rather than start a new block. An image or a
+# '---' rule directly under paragraph text has always been folded into it.
+PARAGRAPH_CONTINUATION_KINDS = frozenset((LINE_TEXT, LINE_IMAGE, LINE_HR))
+
+
+def iter_lines(source: Iterable[str]) -> Iterator[str]:
+    """Yield the lines of ``source`` exactly as ``text.split('\\n')`` would.
+
+    ``source`` is a text file open for reading (or anything else that yields
+    newline-terminated lines). A trailing newline produces a final empty line,
+    as split() does, so a stream and the same text held in memory parse alike.
+    Lines that have no newline, such as the result of a split(), pass through
+    unchanged.
+    """
+    ended = True  # An empty source is one empty line
+    for line in source:
+        ended = line.endswith('\n')
+        yield line[:-1] if ended else line
+    if ended:
+        yield ''
+
+
+# A classified line: (kind, line, match, include). `match` is the block
+# pattern's match for headings, list items and images, the stripped text for
+# fences, and whether a table line is a separator row; `include` is the
+# {% include %} match anywhere on the line, if any. Plain tuples, because one is
+# built for nearly every line parsed.
+LineToken = Tuple[str, str, object, Optional[re.Match]]
+
+
+class InlineMemo:
+    """Bounded LRU of rendered inline fragments, with hit statistics.
+
+    The same list items, table rows and note sentences recur verbatim across
+    distributions; with this in front of convert_inline() each repeat is a
+    dictionary lookup. The caller builds the key, and it must hold everything
+    the rendered result depends on.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[object, str]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[str]:
+        """Return the remembered rendering for ``key``, or None on a miss."""
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result: str):
+        if not self.max_entries:
+            return
+        self._entries[key] = result
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forget every entry, e.g. once the link registry they were rendered against changes."""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def _encode_element(elem: MarkdownElement) -> list:
+    """Compact JSON form of an element: a positional list, children nested."""
+    items = ([[item.depth, item.ordered, item.text] for item in elem.items]
+             if elem.type == 'nested_ul' else elem.items)
+    return [elem.type, elem.content, elem.level, elem.language, items,
+            [_encode_element(child) for child in elem.children]]
+
+
+def _decode_element(data: list) -> MarkdownElement:
+    elem_type, content, level, language, items, children = data
+    if elem_type == 'nested_ul':
+        items = [NestedListItem(*item) for item in items]
+    return MarkdownElement(elem_type, content, level, language, items,
+                           [_decode_element(child) for child in children])
+
+
+class ParseCache:
+    """MarkdownParser.parse() results kept on disk between runs.
+
+    One gzipped JSON file holds every entry, keyed by the SHA-256 of the parsed
+    text, and is stamped with a fingerprint of this script: any edit to the
+    converter can change what parse() returns, so a file written by a different
+    converter is ignored as a whole. Entries are held in their encoded form and
+    decoded on every hit, so callers that rewrite the elements they are given
+    never share objects.
+
+    load() once at startup and save() once at the end; save() keeps this run's
+    entries first and at most ``max_entries`` in total.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: Path, max_entries: int = 4096):
+        self.path = path
+        self.max_entries = max_entries
+        self.fingerprint = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+        self._entries: Dict[str, list] = {}
+        self._used: Dict[str, None] = {}  # Keys hit or added this run, in order
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(content: str) -> str:
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def load(self) -> int:
+        """Read the cache file, if there is a usable one. Returns the entry count."""
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, EOFError, ValueError):
+            return 0  # Missing or unreadable: start empty, overwrite on save
+        if not isinstance(data, dict) or not isinstance(data.get('entries') or {}, dict):
+            self._dirty = True  # Not a cache file at all; replace it
+            return 0
+        if data.get('version') == self.FORMAT_VERSION and data.get('converter') == self.fingerprint:
+            self._entries = data.get('entries') or {}
+        else:
+            self._dirty = True  # Stale; replace it even if nothing new is parsed
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[List[MarkdownElement]]:
+        data = self._entries.get(key)
+        try:
+            elements = None if data is None else [_decode_element(item) for item in data]
+        except (TypeError, ValueError):
+            del self._entries[key]  # Malformed: parse again and overwrite it
+            elements = None
+        if elements is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used[key] = None
+        return elements
+
+    def put(self, key: str, elements: List[MarkdownElement]):
+        self._entries[key] = [_encode_element(elem) for elem in elements]
+        self._used[key] = None
+        self._dirty = True
+
+    def save(self):
+        """Write the cache back if it changed, atomically."""
+        if not self._dirty:
+            return
+        keys = list(self._used)
+        keys += [key for key in self._entries if key not in self._used]
+        entries = {key: self._entries[key] for key in keys[:self.max_entries]}
+        data = {'version': self.FORMAT_VERSION, 'converter': self.fingerprint, 'entries': entries}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f'{self.path.name}.{uuid.uuid4().hex}.tmp')
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
 class MarkdownParser:
     """Parses Markdown content into structured elements."""
 
-    def __init__(self):
+    def __init__(self, inline_cache_size: int = 4096):
         self.include_pattern = re.compile(r'\{%\s*include\s+([^\s%}]+)\s*%\}')
         self.heading_pattern = re.compile(r'^(#{1,6})\s+(.+)$', re.MULTILINE)
         self.code_block_pattern = re.compile(r'```(\w*)\n(.*?)```', re.DOTALL)
         self.inline_code_pattern = re.compile(r'`([^`]+)`')
-        self.bold_pattern = re.compile(r'\*\*(.+?)\*\*')
+        # DOTALL: see convert_inline()
+        self.bold_pattern = re.compile(r'\*\*(.+?)\*\*', re.DOTALL)
+        self.italic_pattern = re.compile(r'\*([^*]+)\*')
         self.link_pattern = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+        self.code_placeholder_pattern = re.compile(r'\x00CODE(\d+)\x00')
         self.list_item_pattern = re.compile(r'^(\s*)[-*]\s+(.+)$', re.MULTILINE)
         self.ordered_list_pattern = re.compile(r'^(\s*)\d+\.\s+(.+)$', re.MULTILINE)
-        # Indented sublist item under an ordered list item: bullet or number
-        self.nested_list_item_pattern = re.compile(r'^(\s+)([-*]|\d+\.)\s+(.+)$')
         self.blockquote_pattern = re.compile(r'^>\s*(.+)$', re.MULTILINE)
         self.hr_pattern = re.compile(r'^---+\s*$', re.MULTILINE)
         self.table_pattern = re.compile(r'^\|(.+)\|$', re.MULTILINE)
+        self.table_separator_pattern = re.compile(r'^\|[-:\s|]+\|$')
+        self.image_line_pattern = re.compile(r'^!\[([^\]]*)\]\(([^)]+)\)\s*$')
+        # A {% raw %}/{% endraw %} marker at the start of a line (see _parse())
+        self.raw_marker_pattern = re.compile(r'[ \t]*\{%-?\s*(?:end)?raw\s*-?%\}[ \t]*')
         # Cross-reference resolution state, set by DITAGenerator before each topic.
         # _convert_link() needs all three: the registry to look targets up in, the
         # source dir to resolve '../..' links against, and the output dir of the
@@ -405,26 +1717,79 @@ class MarkdownParser:
         self._current_source_dir = ""
         self._current_topic_dir = ""
         # Set by DITAGenerator so convert_inline can render inline images; when
-        # unset, inline image markup is left untouched.
+        # unset, inline image markup is left untouched. The image hrefs it writes
+        # depend on the topic's depth, hence the prefix kept alongside.
         self.inline_image_hook = None
-
-    def _is_continuation(self, line: str) -> bool:
-        """True if `line` is wrapped text belonging to the list item above it.
+        self._current_image_prefix = ""
+        self.inline_memo = InlineMemo(inline_cache_size)
+        # Set by DITAGenerator when ConversionConfig.parse_cache is on
+        self.parse_cache: Optional[ParseCache] = None
+
+    def _classify(self, line: str) -> LineToken:
+        """Classify one source line for parse(), looking at it exactly once.
+
+        Dispatches on the first non-space character, so most lines are settled
+        by a single comparison and at most one block pattern is ever tried. An
+        include tag is recorded separately from the kind: it wins in the main
+        loop, but inside a code block, list or table the same line is content.
+        """
+        include = self.include_pattern.search(line) if '{%' in line else None
+        stripped = line.lstrip()
+        if not stripped:
+            return (LINE_BLANK, line, None, include)
+        first = stripped[0]
+        if first == '`' and stripped.startswith('```'):
+            # The fence may be indented: a fence under a list item is authored
+            # that way. The stripped text is kept for the info string and indent.
+            return (LINE_FENCE, line, stripped, include)
+        at_margin = len(stripped) == len(line)
+        if at_margin:
+            if first == '#':
+                match = self.heading_pattern.match(line)
+                return (LINE_HEADING if match else LINE_HASH, line, match, include)
+            if first == '>':
+                return (LINE_QUOTE, line, None, include)
+            if first == '|':
+                # match is True for a |---|---| separator row
+                return (LINE_TABLE, line, bool(self.table_separator_pattern.match(line)), include)
+        if first == '-' or first == '*':
+            match = self.list_item_pattern.match(line)
+            if match:
+                return (LINE_BULLET, line, match, include)
+            if first == '-' and at_margin and self.hr_pattern.match(line):
+                return (LINE_HR, line, None, include)
+        elif first.isdigit():
+            match = self.ordered_list_pattern.match(line)
+            if match:
+                return (LINE_ORDERED, line, match, include)
+        elif first == '!':
+            match = self.image_line_pattern.match(line.strip())
+            if match:
+                return (LINE_IMAGE, line, match, include)
+        return (LINE_TEXT, line, None, include)
+
+    @staticmethod
+    def _is_continuation(token: LineToken) -> bool:
+        """True if `token` is wrapped text belonging to the list item above it.
 
         An indented line that is not itself a list item continues the item. Code
         fences are excluded: an indented fence under a list item is a code block,
         and folding it into the item text would destroy it.
         """
-        if not line.strip() or not line[:1].isspace():
-            return False
-        if line.strip().startswith('```'):
-            return False
-        return not self.nested_list_item_pattern.match(line)
+        return token[0] in LIST_CONTINUATION_KINDS and token[1][:1].isspace()
 
     def parse(self, content: str) -> List[MarkdownElement]:
         """Parse Markdown content into elements."""
-        elements = []
+        if self.parse_cache is None:
+            return self._parse(content)
+        key = self.parse_cache.key(content)
+        elements = self.parse_cache.get(key)
+        if elements is None:
+            elements = self._parse(content)
+            self.parse_cache.put(key, elements)
+        return elements
 
+    def _parse(self, content: str) -> List[MarkdownElement]:
         # Remove YAML front matter
         content = re.sub(r'^---\n.*?\n---\n', '', content, flags=re.DOTALL)
 
@@ -434,235 +1799,269 @@ class MarkdownParser:
         content = re.sub(r'^[ \t]*\{%-?\s*(?:end)?raw\s*-?%\}[ \t]*\n?', '',
                          content, flags=re.MULTILINE)
 
-        # Process content line by line and block by block
-        lines = content.split('\n')
-        i = 0
+        return list(self._blocks(content.split('\n')))
+
+    def iter_parse(self, source: Iterable[str]) -> Iterator[MarkdownElement]:
+        """Parse Markdown from a text file (or any iterable of lines), lazily.
+
+        Lines (newline-terminated, as a file yields them, or already split) are
+        read as they are needed and each element is yielded as soon as its block
+        closes, so memory use is bounded by the largest block rather than the
+        input. Gives the same elements as parse() on the same text, bypassing
+        the parse cache. Front matter and {% raw %} markers are stripped on the
+        way through; only an unclosed front matter block is ever held, until its
+        end shows it is not front matter after all.
+        """
+        return self._blocks(self._without_raw_markers(self._without_front_matter(iter_lines(source))))
+
+    @staticmethod
+    def _without_front_matter(lines: Iterator[str]) -> Iterator[str]:
+        """Streaming form of parse()'s front matter removal.
+
+        The block opens on a first line of exactly '---' and closes on the next
+        such line after at least one line in between; either delimiter only
+        counts when a newline follows it.
+        """
+        first = next(lines, None)
+        if first is None:
+            return
+        held = [first]
+        if first == '---':
+            for line in lines:
+                held.append(line)
+                if line == '---' and len(held) > 2:
+                    after = next(lines, None)
+                    if after is not None:
+                        held = [after]  # Closed: drop the block
+                    break
+        yield from held
+        yield from lines
+
+    def _without_raw_markers(self, lines: Iterator[str]) -> Iterator[str]:
+        """Streaming form of parse()'s {% raw %} marker removal.
+
+        A line that is only a marker disappears with its newline; a marker
+        followed by text leaves the text. Needs one line of lookahead, because
+        the last line has no newline to take with it.
+        """
+        line = next(lines, None)
+        while line is not None:
+            following = next(lines, None)
+            if '{%' in line and 'raw' in line:
+                match = self.raw_marker_pattern.match(line)
+                if match:
+                    line = line[match.end():]
+                    if not line and following is not None:
+                        line = following
+                        continue
+            yield line
+            line = following
 
-        while i < len(lines):
-            line = lines[i]
+    def _blocks(self, lines) -> Iterator[MarkdownElement]:
+        """Group source lines into elements, yielding each as its block closes.
+
+        Lines are classified on the way in, once each, except code block bodies:
+        the only question there is whether a line closes the fence, so they are
+        read raw. Every block rule looks only at the current line, so the input
+        is consumed strictly in order with no lookahead.
+        """
+        lines = iter(lines)
+        tokens = map(self._classify, lines)
+        is_continuation = self._is_continuation
+        tok = next(tokens, None)
+
+        while tok is not None:
+            kind, line, match, include = tok
 
             # Check for Jekyll include
-            include_match = self.include_pattern.search(line)
-            if include_match:
-                elements.append(MarkdownElement(
-                    type='include',
-                    content=include_match.group(1).strip()
-                ))
-                i += 1
+            if include:
+                yield MarkdownElement(type='include', content=include.group(1).strip())
+                tok = next(tokens, None)
                 continue
 
-            # Check for heading
-            heading_match = self.heading_pattern.match(line)
-            if heading_match:
-                level = len(heading_match.group(1))
-                elements.append(MarkdownElement(
+            if kind == LINE_HEADING:
+                yield MarkdownElement(
                     type='heading',
-                    content=heading_match.group(2).strip(),
-                    level=level
-                ))
-                i += 1
+                    content=match.group(2).strip(),
+                    level=len(match.group(1))
+                )
+                tok = next(tokens, None)
                 continue
 
-            # Check for code block start. The fence may be indented: a fence under
-            # a list item is authored that way, and a column-zero-only test leaves
-            # it to the paragraph handler, which folds the whole block -- backticks
-            # and all -- into one <p>.
-            fence = line.lstrip()
-            if fence.startswith('```'):
-                fence_indent = len(line) - len(fence)
-                lang = fence[3:].strip()
+            # Code block. An indented fence under a list item has to be handled
+            # here too: left to the paragraph handler, the whole block -- backticks
+            # and all -- is folded into one <p>.
+            if kind == LINE_FENCE:
+                fence_indent = len(line) - len(match)
                 code_lines = []
-                i += 1
-                while i < len(lines) and not lines[i].lstrip().startswith('```'):
+                # Reading `lines` directly skips classifying the body; the
+                # closing fence is consumed here too
+                for code_line in lines:
+                    if code_line.lstrip().startswith('```'):
+                        break
                     # Remove the fence's own indentation so the code is not
                     # re-indented inside <codeblock>, which is preformatted.
-                    code_lines.append(dedent_line(lines[i], fence_indent))
-                    i += 1
-                elements.append(MarkdownElement(
+                    code_lines.append(dedent_line(code_line, fence_indent))
+                yield MarkdownElement(
                     type='code_block',
                     content='\n'.join(code_lines),
-                    language=lang
-                ))
-                i += 1  # Skip closing ```
+                    language=match[3:].strip()
+                )
+                tok = next(tokens, None)
                 continue
 
-            # Check for horizontal rule
-            if self.hr_pattern.match(line):
-                i += 1
+            if kind == LINE_HR:
+                tok = next(tokens, None)
                 continue  # Skip HR in DITA
 
-            # Check for blockquote
-            if line.startswith('>'):
+            if kind == LINE_QUOTE:
                 quote_lines = []
-                while i < len(lines) and lines[i].startswith('>'):
-                    quote_lines.append(lines[i][1:].strip())
-                    i += 1
-                elements.append(MarkdownElement(
-                    type='note',
-                    content='\n'.join(quote_lines)
-                ))
+                while tok is not None and tok[0] == LINE_QUOTE:
+                    quote_lines.append(tok[1][1:].strip())
+                    tok = next(tokens, None)
+                yield MarkdownElement(type='note', content='\n'.join(quote_lines))
                 continue
 
-            # Check for unordered list
-            list_match = self.list_item_pattern.match(line)
-            if list_match:
+            if kind == LINE_BULLET:
                 items = []
-                while i < len(lines):
-                    match = self.list_item_pattern.match(lines[i])
-                    if match:
-                        items.append(match.group(2).strip())
-                        i += 1
-                        continue
-                    if self._is_continuation(lines[i]) and items:
+                while tok is not None:
+                    if tok[0] == LINE_BULLET:
+                        items.append(tok[2].group(2).strip())
+                    elif is_continuation(tok):
                         # Wrapped item text; without this the list ends here and
                         # the remainder of the item becomes a stray paragraph.
-                        items[-1] += ' ' + lines[i].strip()
-                        i += 1
-                        continue
-                    break
-                elements.append(MarkdownElement(
-                    type='unordered_list',
-                    content='',
-                    items=items
-                ))
+                        items[-1] += ' ' + tok[1].strip()
+                    else:
+                        break
+                    tok = next(tokens, None)
+                yield MarkdownElement(type='unordered_list', content='', items=items)
                 continue
 
-            # Check for ordered list (with nested sublists support)
-            ol_match = self.ordered_list_pattern.match(line)
-            if ol_match:
-                # Parse ordered list with potential nested bullet/numbered items
+            # Ordered list (with nested sublists support)
+            if kind == LINE_ORDERED:
                 ol_items = []  # List of tuples: (item_text, [nested_items])
                 # The first item sets the list's own level. Usually that is column
                 # zero, but a list can also open already indented (a sublist whose
                 # parent is a plain indented paragraph); treating that as "not a
                 # list" would drop it to loose paragraphs.
-                base_indent = ol_match.group(1)
-
-                while i < len(lines):
-                    current_line = lines[i]
-
-                    # Check if this is an ordered list item at the list's own level
-                    ol_item_match = self.ordered_list_pattern.match(current_line)
-                    if ol_item_match and ol_item_match.group(1) == base_indent:
-                        item_text = ol_item_match.group(2).strip()
-                        nested_items = []
-                        i += 1
-
-                        # Collect nested list items (indented bullets or numbers).
-                        # Numbered sublists have to be accepted here: leaving them
-                        # to the outer loop spins forever, because an indented
-                        # ordered item re-enters this branch, collects nothing,
-                        # and never advances i.
-                        # A sublist item has to be indented deeper than the list's
-                        # own level; at exactly base_indent it is a sibling, which
-                        # the outer loop handles on the next pass.
-                        nest_min = max(2, len(base_indent) + 1)
-                        saw_blank = False
-                        while i < len(lines):
-                            nested_line = lines[i]
-                            nested_match = self.nested_list_item_pattern.match(nested_line)
-                            if nested_match and len(nested_match.group(1)) >= nest_min:
-                                nested_items.append(NestedListItem(
-                                    depth=len(nested_match.group(1)),
-                                    ordered=nested_match.group(2)[0].isdigit(),
-                                    text=nested_match.group(3).strip()
-                                ))
-                                i += 1
-                                saw_blank = False
-                            elif nested_line.strip() == '':
-                                # Empty line - check if next line continues the list
-                                saw_blank = True
-                                i += 1
-                            elif not saw_blank and self._is_continuation(nested_line):
-                                # Wrapped item text. Only when it directly follows
-                                # the item: an indented block after a blank line is
-                                # separate content, not a continuation, and folding
-                                # it in would swallow whole paragraphs.
-                                if nested_items:
-                                    nested_items[-1].text += ' ' + nested_line.strip()
-                                else:
-                                    item_text += ' ' + nested_line.strip()
-                                i += 1
+                base_indent = match.group(1)
+                # A sublist item has to be indented deeper than the list's own
+                # level; at exactly base_indent it is a sibling.
+                nest_min = max(2, len(base_indent) + 1)
+
+                while tok is not None and tok[0] == LINE_ORDERED and tok[2].group(1) == base_indent:
+                    item_text = tok[2].group(2).strip()
+                    nested_items = []
+                    tok = next(tokens, None)
+
+                    # Collect nested list items (indented bullets or numbers)
+                    saw_blank = False
+                    while tok is not None:
+                        if tok[0] in LIST_ITEM_KINDS and len(tok[2].group(1)) >= nest_min:
+                            nested_items.append(NestedListItem(
+                                depth=len(tok[2].group(1)),
+                                ordered=tok[0] == LINE_ORDERED,
+                                text=tok[2].group(2).strip()
+                            ))
+                            saw_blank = False
+                        elif tok[0] == LINE_BLANK:
+                            # Empty line - check if next line continues the list
+                            saw_blank = True
+                        elif not saw_blank and is_continuation(tok):
+                            # Wrapped item text. Only when it directly follows
+                            # the item: an indented block after a blank line is
+                            # separate content, not a continuation, and folding
+                            # it in would swallow whole paragraphs.
+                            if nested_items:
+                                nested_items[-1].text += ' ' + tok[1].strip()
                             else:
-                                # Not a nested item, break out
-                                break
+                                item_text += ' ' + tok[1].strip()
+                        else:
+                            break
+                        tok = next(tokens, None)
 
-                        ol_items.append((item_text, nested_items))
-                    else:
-                        # Not an ordered list item at root level, stop collecting
-                        break
-
-                if ol_items:
-                    elements.append(MarkdownElement(
-                        type='ordered_list_nested',
-                        content='',
-                        items=[item[0] for item in ol_items],  # Main item texts
-                        children=[MarkdownElement(type='nested_ul', content='', items=item[1])
-                                  for item in ol_items]  # Nested sublists
-                    ))
-                    continue
+                    ol_items.append((item_text, nested_items))
 
-                # An indented ordered item with no root-level item to attach it
-                # to (e.g. the document opens on a sublist). Fall through to the
-                # paragraph handling below so i always advances.
+                yield MarkdownElement(
+                    type='ordered_list_nested',
+                    content='',
+                    items=[item[0] for item in ol_items],  # Main item texts
+                    children=[MarkdownElement(type='nested_ul', content='', items=item[1])
+                              for item in ol_items]  # Nested sublists
+                )
+                continue
 
-            # Check for table
-            if line.startswith('|'):
+            if kind == LINE_TABLE:
                 table_lines = []
-                while i < len(lines) and lines[i].startswith('|'):
-                    # Skip separator lines (|---|---|)
-                    if not re.match(r'^\|[-:\s|]+\|$', lines[i]):
-                        table_lines.append(lines[i])
-                    i += 1
+                while tok is not None and tok[0] == LINE_TABLE:
+                    if not tok[2]:  # Skip separator lines (|---|---|)
+                        table_lines.append(tok[1])
+                    tok = next(tokens, None)
                 if table_lines:
-                    elements.append(MarkdownElement(
-                        type='table',
-                        content='\n'.join(table_lines)
-                    ))
+                    yield MarkdownElement(type='table', content='\n'.join(table_lines))
                 continue
 
-            # Check for image
-            image_match = re.match(r'^!\[([^\]]*)\]\(([^)]+)\)\s*$', line.strip())
-            if image_match:
-                alt_text = image_match.group(1) or 'Image'
-                image_path = image_match.group(2)
-                elements.append(MarkdownElement(
+            if kind == LINE_IMAGE:
+                yield MarkdownElement(
                     type='image',
-                    content=image_path,
-                    language=alt_text  # Reuse language field for alt text
-                ))
-                i += 1
+                    content=match.group(2),
+                    language=match.group(1) or 'Image'  # Reuse language field for alt text
+                )
+                tok = next(tokens, None)
                 continue
 
             # Regular paragraph
-            if line.strip():
-                para_lines = [line]
-                i += 1
-                while i < len(lines) and lines[i].strip() and \
-                      not lines[i].startswith('#') and \
-                      not lines[i].lstrip().startswith('```') and \
-                      not lines[i].startswith('>') and \
-                      not lines[i].startswith('|') and \
-                      not self.list_item_pattern.match(lines[i]) and \
-                      not self.ordered_list_pattern.match(lines[i]) and \
-                      not self.include_pattern.search(lines[i]):
-                    para_lines.append(lines[i])
-                    i += 1
-                elements.append(MarkdownElement(
+            if kind != LINE_BLANK:
+                para_lines = [line.strip()]
+                tok = next(tokens, None)
+                while tok is not None and tok[0] in PARAGRAPH_CONTINUATION_KINDS and not tok[3]:
+                    para_lines.append(tok[1].strip())
+                    tok = next(tokens, None)
+                yield MarkdownElement(
                     type='paragraph',
                     # Strip each line: source indentation and wrap points are not
                     # content, and leaving them in emits <p> text that starts with
                     # whitespace or has double spaces at every wrap.
-                    content=' '.join(l.strip() for l in para_lines)
-                ))
+                    content=' '.join(para_lines)
+                )
                 continue
 
-            i += 1
-
-        return elements
+            tok = next(tokens, None)
 
     def convert_inline(self, text: str) -> str:
         """Convert inline Markdown formatting to DITA."""
+        # Each pass needs its own marker character, and most fragments (table
+        # cells, plain sentences) have none, so look first and run only the
+        # passes that can match. A link needs '](' literally: stashing code and
+        # substituting emphasis never moves a ']' or a '('.
+        has_code = '`' in text
+        has_emphasis = '*' in text
+        has_link = '](' in text
+        if not (has_code or has_emphasis or has_link):
+            return text
+
+        # Only links (and inline images, which are link-shaped) render
+        # differently depending on where the topic is; anything else is keyed by
+        # its text alone, so a repeat hits from any guide
+        if has_link:
+            key = (text, self._current_source_dir, self._current_topic_dir, self._current_image_prefix)
+        else:
+            key = text
+        result = self.inline_memo.get(key)
+        if result is None:
+            result = self._render_inline(text, has_code, has_emphasis, has_link)
+            self.inline_memo.put(key, result)
+        return result
+
+    def _render_inline(self, text: str, has_code: bool, has_emphasis: bool, has_link: bool) -> str:
+        """convert_inline() without the memo, running the passes the flags call for."""
+        if '\x00' in text:
+            # Would collide with the code placeholders; take the full route
+            has_code = has_emphasis = has_link = True
+        elif has_code and not (has_emphasis or has_link):
+            # Code spans alone need no protecting
+            return self.inline_code_pattern.sub(r'<codeph>\1</codeph>', text)
+
         # Protect inline code spans FIRST so their contents are not treated as
         # emphasis or links. Without this, `sd*` ... `dm-*` would be parsed as an
         # italic run spanning the two code spans, producing mismatched <i> tags.
@@ -672,23 +2071,27 @@ class MarkdownParser:
             code_spans.append(match.group(1))
             return f'\x00CODE{len(code_spans) - 1}\x00'
 
-        text = re.sub(r'`([^`]+)`', _stash_code, text)
-        # Bold. The span content is matched non-greedily rather than as
-        # "anything but a star", so that an italic run nested inside a bold run
-        # survives: '**bold with *italic* inside**' used to fall through to the
-        # italic pass and emit mismatched '*<i>' markup.
-        # DOTALL is required: blockquote lines are joined with newlines before they
-        # get here, and authored bold spans routinely wrap across source lines.
-        # ('[^*]+' matched newlines for free; '.+?' does not.)
-        text = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', text, flags=re.DOTALL)
-        # Italic. Runs second, so it also picks up emphasis nested in the bold
-        # content substituted above.
-        text = re.sub(r'\*([^*]+)\*', r'<i>\1</i>', text)
-        # Links - handle internal .md links vs external links
-        text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', self._convert_link, text)
-        # Restore inline code spans as <codeph>
-        text = re.sub(r'\x00CODE(\d+)\x00',
-                      lambda m: f'<codeph>{code_spans[int(m.group(1))]}</codeph>', text)
+        if has_code:
+            text = self.inline_code_pattern.sub(_stash_code, text)
+        if has_emphasis:
+            # Bold. The span content is matched non-greedily rather than as
+            # "anything but a star", so that an italic run nested inside a bold
+            # run survives: '**bold with *italic* inside**' used to fall through
+            # to the italic pass and emit mismatched '*<i>' markup.
+            # DOTALL is required: blockquote lines are joined with newlines before
+            # they get here, and authored bold spans routinely wrap across source
+            # lines. ('[^*]+' matched newlines for free; '.+?' does not.)
+            text = self.bold_pattern.sub(r'<b>\1</b>', text)
+            # Italic. Runs second, so it also picks up emphasis nested in the bold
+            # content substituted above.
+            text = self.italic_pattern.sub(r'<i>\1</i>', text)
+        if has_link:
+            # Links - handle internal .md links vs external links
+            text = self.link_pattern.sub(self._convert_link, text)
+        if has_code:
+            # Restore inline code spans as <codeph>
+            text = self.code_placeholder_pattern.sub(
+                lambda m: f'<codeph>{code_spans[int(m.group(1))]}</codeph>', text)
         return text
 
     def _normalize_source_ref(self, href: str) -> str:
@@ -851,14 +2254,46 @@ class DITAGenerator:
 
     def __init__(self, config: ConversionConfig):
         self.config = config
-        self.parser = MarkdownParser()
+        self.parser = MarkdownParser(config.inline_cache_size)
+        if config.parse_cache:
+            self.parser.parse_cache = ParseCache(config.parse_cache)
+            self.parser.parse_cache.load()
         self.warehouse_ids = {}  # Maps include paths to warehouse IDs
         self.images_dir = config.output_dir / config.images_dir
         self.diagram_counter = 0  # Counter for diagrams within current source file
         self._include_cache = {}  # Cache for resolved include content
+        # Includes such as quickstart/* and the disclaimers are referenced by
+        # dozens of guides; each is parsed, and each nested-include tree
+        # expanded, once per run. The cached lists are shared between callers
+        # and must not be modified.
+        self._parsed_includes: Dict[str, List[MarkdownElement]] = {}
+        self._flattened_includes: Dict[Tuple[str, int], List[MarkdownElement]] = {}
+        self._expanded_include_text: Dict[Tuple[str, int], str] = {}
+        self._include_stack: List[str] = []  # Includes being expanded, outermost first
         self._current_source_context = "unknown"  # Human-readable source context
+        self._current_source_file = ""  # Source path as given to set_source_context()
         self._image_prefix = "../images/"  # Relative path to images/ from the current topic
         self.parser.inline_image_hook = self._inline_image_dita
+        # Diagrams are not rendered while topics are generated. Each one is
+        # recorded as a DiagramJob and its final href emitted straight away (the
+        # filename does not depend on the render); render_diagrams() then works
+        # through the whole manifest as one batch once the topics are written.
+        self.diagram_manifest: List[DiagramJob] = []
+        self._manifest_filenames = set()
+        self.diagram_records: List[DiagramRecord] = []  # One per render, for the diagram report
+        self._records_lock = threading.Lock()
+        self._retry_policy = RetryPolicy(max_attempts=config.diagram_retries)
+        self.renderer = make_diagram_renderer(config)
+        cache_dir = config.diagram_cache_dir or default_diagram_cache_dir()
+        if config.diagram_renderer != 'kroki':
+            # Other renderers draw different pictures of the same source
+            cache_dir = cache_dir / config.diagram_renderer
+        self.diagram_cache = DiagramCache(cache_dir, max_bytes=config.diagram_cache_size)
+        # Flattening decodes and re-encodes every transparent PNG, which is CPU
+        # work the render threads would otherwise do one GIL at a time; it runs
+        # in a process pool started on first use
+        self._flatten_pool: Optional[ProcessPoolExecutor] = None
+        self._flatten_lock = threading.Lock()
 
     def _inline_image_dita(self, src: str, alt: str) -> str:
         """Render an image that appears inside a paragraph or list item."""
@@ -876,6 +2311,7 @@ class DITAGenerator:
         """
         parts = [p for p in str(subdir or '').replace('\\', '/').split('/') if p]
         self._image_prefix = '../' * (len(parts) + 1) + 'images/'
+        self.parser._current_image_prefix = self._image_prefix
         # Remember where this topic lives so cross-references can be made relative
         # to it. Stored as a collection-root-relative POSIX path, e.g.
         # 'topics/openshift/nfs'.
@@ -884,6 +2320,8 @@ class DITAGenerator:
     def set_link_registry(self, registry: dict):
         """Provide the source-path -> output-topic mapping used for xrefs."""
         self.parser._link_registry = registry or {}
+        # Renderings of links were made against the old registry
+        self.parser.inline_memo.clear()
 
     def set_source_context(self, rel_path: str):
         """Set the current source file context for human-readable diagram names.
@@ -896,12 +2334,14 @@ class DITAGenerator:
         # Reset image depth; callers that write into a nested topics/ subdirectory
         # override this with set_topic_subdir() before generating content.
         self._image_prefix = "../images/"
+        self.parser._current_image_prefix = self._image_prefix
 
         # Remember the source file's directory so relative links such as
         # '../../kubernetes/nfs/QUICKSTART.md' can be resolved back to a
         # repo-relative path and looked up in the link registry.
         norm = rel_path.replace('\\', '/')
         self.parser._current_source_dir = norm.rsplit('/', 1)[0] if '/' in norm else ''
+        self._current_source_file = norm
 
         # Convert path to human-readable context
         # e.g., "distributions/rhel/nvme-tcp/QUICKSTART.md" -> "rhel-nvme-tcp-quickstart"
@@ -931,13 +2371,42 @@ class DITAGenerator:
             print(f"    Warning: Include file not found: {include_path}")
             return ""
 
+    def _parsed_include(self, include_path: str) -> List[MarkdownElement]:
+        """The parsed elements of an include, parsed once per run (shared; do not modify)."""
+        elements = self._parsed_includes.get(include_path)
+        if elements is None:
+            content = self._resolve_include(include_path)
+            if not content:
+                return []  # Not cached, so a missing include warns at every use, as before
+            elements = self._parsed_includes[include_path] = self.parser.parse(content)
+        return elements
+
+    def _include_cycle(self, include_path: str) -> bool:
+        """True, with a warning, if ``include_path`` is already being expanded.
+
+        An include that reaches itself again would otherwise recurse until the
+        interpreter gives up. The repeat is left out instead.
+        """
+        if include_path not in self._include_stack:
+            return False
+        chain = ' -> '.join(self._include_stack[self._include_stack.index(include_path):] + [include_path])
+        print(f"    Warning: Include cycle {chain}; not expanding {include_path} again")
+        return True
+
     def _inline_include_to_dita(self, include_path: str, indent: str = '        ') -> str:
         """Convert an include file's content to inline DITA elements."""
-        content = self._resolve_include(include_path)
-        if not content:
+        if not self._resolve_include(include_path):
             return f'{indent}<!-- Include not found: {include_path} -->'
+        if self._include_cycle(include_path):
+            return f'{indent}<!-- Include cycle: {include_path} -->'
 
-        elements = self.parser.parse(content)
+        self._include_stack.append(include_path)
+        try:
+            return self._include_elements_to_dita(self._parsed_include(include_path), indent)
+        finally:
+            self._include_stack.pop()
+
+    def _include_elements_to_dita(self, elements: List[MarkdownElement], indent: str) -> str:
         output = []
 
         for elem in elements:
@@ -986,18 +2455,119 @@ class DITAGenerator:
             # Return a placeholder comment for testing runs
             return f'<!-- Mermaid diagram {self.diagram_counter} (skipped) -->'
 
-        filename = download_mermaid_image(
-            mermaid_code,
-            self.images_dir,
-            self._current_source_context,
-            self.diagram_counter
-        )
+        fmt = self.config.diagram_format
+        if self.config.shared_diagrams:
+            filename = shared_diagram_filename(mermaid_code, fmt)
+        else:
+            filename = f"{self._current_source_context}-diagram-{self.diagram_counter:02d}.{fmt}"
+        if filename not in self._manifest_filenames:
+            # A shared diagram is recorded once however many topics include it
+            self._manifest_filenames.add(filename)
+            self.diagram_manifest.append(DiagramJob(
+                source=mermaid_code,
+                context=self._current_source_context,
+                number=self.diagram_counter,
+                target=self.images_dir / filename,
+                source_file=self._current_source_file))
 
         image_path = f"{self._image_prefix}{filename}"
 
         # Include scope attribute for proper Heretto CCMS linking
         return f'<fig><image href="{escape_xml_attr(image_path)}" scope="local"><alt>Diagram</alt></image></fig>'
 
+    def render_diagrams(self) -> Dict[str, str]:
+        """Render every job in the diagram manifest as one batch.
+
+        Jobs run on a pool of ``diagram_jobs`` worker threads sharing one
+        renderer, retry policy and RenderBudget; the budget's deadline covers
+        this phase alone. Returns {filename: error_filename} for each render that
+        failed, so the caller can repoint hrefs that were written before the
+        outcome was known at the same '-error' name a serial run emitted.
+        """
+        jobs, self.diagram_manifest = self.diagram_manifest, []
+        if not jobs:
+            return {}
+        budget = RenderBudget(max_failures=self.config.diagram_failure_budget,
+                              deadline=self.config.diagram_deadline)
+        flight = SingleFlight()
+
+        def render(job: DiagramJob) -> str:
+            record = DiagramRecord(source_file=job.source_file, number=job.number,
+                                   content_hash=diagram_hash(job.source), filename=job.filename)
+            started = time.monotonic()
+            result = download_mermaid_image(job.source, job.target.parent, job.context, job.number,
+                                            self.diagram_cache, job.filename, self._retry_policy,
+                                            budget, self.renderer, flight, self._flatten_png,
+                                            self.config.diagram_format, record)
+            record.seconds = round(time.monotonic() - started, 3)
+            record.filename, record.ok = result, result == job.filename
+            with self._records_lock:
+                self.diagram_records.append(record)
+            return result
+
+        started = time.monotonic()
+        if self.config.diagram_jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.config.diagram_jobs) as pool:
+                results = list(pool.map(render, jobs))
+        else:
+            results = [render(job) for job in jobs]
+        self.renderer.close()
+        if self._flatten_pool is not None:
+            self._flatten_pool.shutdown()
+            self._flatten_pool = None
+        self.diagram_cache.prune()
+
+        failed = {job.filename: result for job, result in zip(jobs, results)
+                  if result != job.filename}
+        shared = f", {flight.coalesced} shared an identical render" if flight.coalesced else ""
+        print(f"  Rendered {len(jobs) - len(failed)} of {len(jobs)} diagrams "
+              f"in {time.monotonic() - started:.1f}s ({len(failed)} failed{shared})")
+        return failed
+
+    def prefetch_diagrams(self, sources: List[str]) -> Tuple[int, Dict[str, str]]:
+        """Render the given Mermaid sources into the render cache only.
+
+        Sources already cached are skipped; the rest go through
+        render_diagrams() as one batch, written to a scratch directory that is
+        discarded afterwards. An adaptive limiter starts this batch at the full
+        ``diagram_jobs`` rather than ramping up to it. Returns (number rendered,
+        failures).
+        """
+        fmt = self.config.diagram_format
+        pending = {}
+        for code in sources:
+            key = diagram_hash(code)
+            if key not in pending and self.diagram_cache.get(key, fmt) is None:
+                pending[key] = code
+        if not pending:
+            return 0, {}
+        limiter = getattr(self.renderer, 'limiter', None)
+        if limiter is not None:
+            limiter.saturate()
+        with tempfile.TemporaryDirectory(prefix='diagram-prefetch-') as scratch:
+            self.diagram_manifest.extend(
+                DiagramJob(source=code, context='prefetch', number=num,
+                           target=Path(scratch) / shared_diagram_filename(code, fmt))
+                for num, code in enumerate(pending.values(), 1))
+            failed = self.render_diagrams()
+        return len(pending), failed
+
+    def _flatten_png(self, data: bytes) -> bytes:
+        """flatten_png() in the worker process pool; opaque images skip the pool."""
+        if png_is_opaque(data) or importlib.util.find_spec("PIL") is None:
+            return data
+        with self._flatten_lock:
+            if self._flatten_pool is None:
+                # Created from a render thread while the others run: a forked
+                # child would inherit their held locks, so start the workers
+                # from a fresh interpreter instead
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._flatten_pool = ProcessPoolExecutor(max_workers=min(self.config.diagram_jobs,
+                                                                         os.cpu_count() or 1),
+                                                         mp_context=context)
+        return self._flatten_pool.submit(flatten_png, data).result()
+
     def _resolve_image_path(self, src_path: str) -> str:
         """Resolve a markdown image path to a DITA-relative path.
 
@@ -1103,7 +2673,11 @@ class DITAGenerator:
 
     def generate_concept_topic(self, title: str, content: str, topic_id: str) -> str:
         """Generate a DITA concept topic (for BEST-PRACTICES guides)."""
-        elements = self.parser.parse(content)
+        return self.generate_concept_topic_from_elements(title, self.parser.parse(content), topic_id)
+
+    def generate_concept_topic_from_elements(self, title: str, elements: List[MarkdownElement],
+                                             topic_id: str) -> str:
+        """Generate a DITA concept topic from already parsed elements."""
         body_content = self._elements_to_dita(elements, topic_id)
         prolog = self._generate_prolog(topic_id, 'concept')
 
@@ -1180,10 +2754,7 @@ class DITAGenerator:
         flat = []
         for elem in elements:
             if elem.type == 'include' and self.config.inline_includes:
-                inc_content = self._resolve_include(elem.content)
-                if inc_content:
-                    flat.extend(self._flatten_elements(
-                        self.parser.parse(inc_content), offset + 1))
+                flat.extend(self._flattened_include(elem.content, offset + 1))
             elif elem.type == 'heading' and offset:
                 flat.append(MarkdownElement(
                     type='heading', content=elem.content, level=elem.level + offset,
@@ -1192,6 +2763,54 @@ class DITAGenerator:
                 flat.append(elem)
         return flat
 
+    def _flattened_include(self, include_path: str, offset: int) -> List[MarkdownElement]:
+        """An include's elements with its own includes expanded, as _flatten_elements() needs them.
+
+        Cached per include and nesting offset, since the offset sets how far
+        its headings are demoted. Shared; do not modify.
+        """
+        key = (include_path, offset)
+        flat = self._flattened_includes.get(key)
+        if flat is not None:
+            return flat
+        if self._include_cycle(include_path):
+            return []
+        self._include_stack.append(include_path)
+        try:
+            flat = self._flatten_elements(self._parsed_include(include_path), offset)
+        finally:
+            self._include_stack.pop()
+        if self._resolve_include(include_path):
+            self._flattened_includes[key] = flat
+        return flat
+
+    def expand_include_text(self, text: str, depth: int = 0) -> str:
+        """Inline the include directives in raw Markdown ``text``, recursively.
+
+        For scans that work on source text rather than elements. Directives
+        nested more than three includes deep are left as they are. Each
+        include's expansion is cached per depth.
+        """
+        if depth > 3:
+            return text
+
+        def sub(match):
+            include_path = match.group(1)
+            key = (include_path, depth + 1)
+            expanded = self._expanded_include_text.get(key)
+            if expanded is None:
+                if self._include_cycle(include_path):
+                    return ''
+                self._include_stack.append(include_path)
+                try:
+                    expanded = self.expand_include_text(self._resolve_include(include_path), depth + 1)
+                finally:
+                    self._include_stack.pop()
+                self._expanded_include_text[key] = expanded
+            return expanded
+
+        return self.parser.include_pattern.sub(sub, text)
+
     def _choose_section_level(self, levels: List[int]) -> Optional[int]:
         """Pick the heading level to turn into <section> boundaries.
 
@@ -1900,6 +3519,7 @@ class MarkdownToDITAConverter:
         """Run the full conversion process."""
         if self.config.standalone_file:
             self._convert_standalone()
+            self._finish_caches()
             return
 
         print(f"Starting conversion from {self.config.input_dir}")
@@ -1920,18 +3540,39 @@ class MarkdownToDITAConverter:
         print("\n=== Converting main documentation files ===")
         self._convert_main_docs()
 
-        # Step 3: Generate DITA map
+        # Step 3: Render the diagrams the topics reference, as one batch
+        self._render_diagrams()
+
+        # Step 4: Generate DITA map
         print("\n=== Generating DITA map ===")
         self._generate_map()
 
+        self._finish_caches()
         print(f"\nConversion complete! Output written to: {self.config.output_dir}")
 
+    def _finish_caches(self):
+        """Save the parse cache and print how much work the caches saved."""
+        stats = self.dita_gen.parser.inline_memo.stats()
+        if stats['hits'] or stats['misses']:
+            print(f"\nInline fragments: {stats['hits']} of {stats['hits'] + stats['misses']} "
+                  f"served from memory ({stats['hit_rate']:.0%}), {stats['entries']} remembered")
+        parse_cache = self.dita_gen.parser.parse_cache
+        if parse_cache is not None:
+            parse_cache.save()
+            stats = parse_cache.stats()
+            print(f"Parse cache: {stats['hits']} of {stats['hits'] + stats['misses']} documents "
+                  f"reused from {parse_cache.path}")
+
     def _convert_standalone(self):
         """Convert a standalone markdown file to DITA topics and map.
 
         Splits the document by H1 headings (chapters) into separate concept topics.
         Each chapter's H2 sections become DITA sections within the topic.
         Images are copied from the source directory to the output images directory.
+
+        The file is streamed: chapters are cut from it as it is read and each
+        is converted and written before the next is read, so a multi-megabyte
+        PDF-extracted guide is never held in memory whole.
         """
         import shutil
 
@@ -1941,8 +3582,6 @@ class MarkdownToDITAConverter:
         # Create output directories
         self._create_output_dirs()
 
-        content = md_file.read_text(encoding='utf-8')
-
         # Copy images from source directory to output images directory
         source_images_dir = md_file.parent / 'images'
         if source_images_dir.exists():
@@ -1956,17 +3595,17 @@ class MarkdownToDITAConverter:
                         copied += 1
             print(f"  Copied {copied} images to {output_images}")
 
-        # Remove TOC section (between "## Table of Contents" and "---")
-        content = re.sub(r'## Table of Contents\n.*?---\n', '', content, flags=re.DOTALL)
-
-        # Extract document title. Use search, not match: a compiled document may
-        # open with a provenance comment or a table of contents, in which case an
-        # anchored match falls back to the filename stem for the map title.
-        title_match = re.search(r'^#\s+(.+)$', content, re.MULTILINE)
-        doc_title = title_match.group(1).strip() if title_match else md_file.stem
-
         # Single task topic mode: emit one task topic from the entire file
         if self.config.single_task:
+            content = md_file.read_text(encoding='utf-8')
+            # Remove TOC section (between "## Table of Contents" and "---")
+            content = re.sub(r'## Table of Contents\n.*?---\n', '', content, flags=re.DOTALL)
+            # Extract document title. Use search, not match: a compiled document may
+            # open with a provenance comment or a table of contents, in which case an
+            # anchored match falls back to the filename stem for the map title.
+            title_match = re.search(r'^#\s+(.+)$', content, re.MULTILINE)
+            doc_title = title_match.group(1).strip() if title_match else md_file.stem
+
             base_id = sanitize_id(md_file.stem)
             topic_id = f"t_{base_id}"
             self.dita_gen.set_source_context(md_file.stem)
@@ -1979,76 +3618,150 @@ class MarkdownToDITAConverter:
                 'id': topic_id, 'title': doc_title,
                 'relative_path': md_file.name, 'type': 'task', 'subdir': ''
             })
+        else:
+            with md_file.open(encoding='utf-8') as source:
+                doc_title = self._convert_standalone_chapters(md_file, source)
 
-            # Generate DITA map
-            print(f"\n=== Generating DITA map ===")
-            map_content = self._generate_standalone_map(doc_title)
-            map_file = self.config.output_dir / self.config.maps_dir / f"{sanitize_id(md_file.stem)}.ditamap"
-            map_file.write_text(map_content, encoding='utf-8')
-            print(f"  Created map: {map_file.name}")
+        self._render_diagrams()
 
-            print(f"\nStandalone conversion complete!")
-            print(f"   Topics: {len(self.converted_topics)}")
-            print(f"   Output: {self.config.output_dir}")
-            return
+        # Generate DITA map
+        print(f"\n=== Generating DITA map ===")
+        map_content = self._generate_standalone_map(doc_title)
+        map_file = self.config.output_dir / self.config.maps_dir / f"{sanitize_id(md_file.stem)}.ditamap"
+        map_file.write_text(map_content, encoding='utf-8')
+        print(f"  Created map: {map_file.name}")
 
-        # Split by H1 headings (chapters)
-        h1_pattern = r'^#\s+(.+)$'
-        h1_matches = list(re.finditer(h1_pattern, content, re.MULTILINE))
+        print(f"\nStandalone conversion complete!")
+        print(f"   Topics: {len(self.converted_topics)}")
+        print(f"   Output: {self.config.output_dir}")
 
-        if not h1_matches:
-            # No H1 headings — treat entire document as one topic
-            base_id = sanitize_id(md_file.stem)
+    def _convert_standalone_chapters(self, md_file: Path, source) -> str:
+        """Write one concept topic per H1 chapter read from ``source``; return the document title.
+
+        The document title is the first H1, falling back to the filename stem
+        when there is none.
+        """
+        doc_title = md_file.stem
+        topics_dir = self.config.output_dir / self.config.topics_dir
+        for chapter_title, chapter_lines in self._standalone_chapters(iter_lines(source)):
+            # iter_parse() bypasses the parse cache, which would otherwise hold
+            # every chapter's elements until the end of the run
+            elements = list(self.dita_gen.parser.iter_parse(chapter_lines))
+            if chapter_title is None:
+                # No H1 headings — treat entire document as one topic
+                base_id = sanitize_id(md_file.stem)
+                topic_id = f"c_{base_id}"
+                self.dita_gen.set_source_context(md_file.stem)
+                dita_content = self.dita_gen.generate_concept_topic_from_elements(doc_title, elements, topic_id)
+                dita_content = remove_non_ascii(dita_content)
+                (topics_dir / f"{topic_id}.dita").write_text(dita_content, encoding='utf-8')
+                self.converted_topics.append({
+                    'id': topic_id, 'title': doc_title,
+                    'relative_path': md_file.name, 'type': 'concept', 'subdir': ''
+                })
+                break
+
+            if not self.converted_topics:
+                doc_title = chapter_title
+                print("\n=== Splitting into chapters ===")
+
+            # Generate topic
+            base_id = sanitize_id(chapter_title)
             topic_id = f"c_{base_id}"
-            self.dita_gen.set_source_context(md_file.stem)
-            dita_content = self.dita_gen.generate_concept_topic(doc_title, content, topic_id)
+            self.dita_gen.set_source_context(base_id)
+
+            dita_content = self.dita_gen.generate_concept_topic_from_elements(
+                chapter_title, elements, topic_id
+            )
             dita_content = remove_non_ascii(dita_content)
-            output_file = self.config.output_dir / self.config.topics_dir / f"{topic_id}.dita"
+
+            output_file = topics_dir / f"{topic_id}.dita"
             output_file.write_text(dita_content, encoding='utf-8')
+            print(f"  Created: {topic_id}.dita ({chapter_title})")
+
             self.converted_topics.append({
-                'id': topic_id, 'title': doc_title,
+                'id': topic_id, 'title': chapter_title,
                 'relative_path': md_file.name, 'type': 'concept', 'subdir': ''
             })
-        else:
-            # Split into chapters at H1 boundaries
-            print(f"\n=== Splitting into {len(h1_matches)} chapters ===")
-            topics_dir = self.config.output_dir / self.config.topics_dir
-
-            for idx, match in enumerate(h1_matches):
-                chapter_title = match.group(1).strip()
-                start = match.end()
-                end = h1_matches[idx + 1].start() if idx + 1 < len(h1_matches) else len(content)
-                chapter_content = content[start:end].strip()
-
-                # Generate topic
-                base_id = sanitize_id(chapter_title)
-                topic_id = f"c_{base_id}"
-                self.dita_gen.set_source_context(base_id)
+        return doc_title
 
-                dita_content = self.dita_gen.generate_concept_topic(
-                    chapter_title, chapter_content, topic_id
-                )
-                dita_content = remove_non_ascii(dita_content)
+    # A chapter heading: any line opening with '# ', code blocks included --
+    # chapters are cut from the raw text, before anything is parsed
+    STANDALONE_H1 = re.compile(r'#\s+(.+)$')
+    STANDALONE_TOC = '## Table of Contents'
 
-                output_file = topics_dir / f"{topic_id}.dita"
-                output_file.write_text(dita_content, encoding='utf-8')
-                print(f"  Created: {topic_id}.dita ({chapter_title})")
+    def _standalone_chapters(self, lines: Iterator[str]) -> Iterator[Tuple[Optional[str], List[str]]]:
+        """Cut a standalone document into (H1 title, chapter lines) pairs.
 
-                self.converted_topics.append({
-                    'id': topic_id, 'title': chapter_title,
-                    'relative_path': md_file.name, 'type': 'concept', 'subdir': ''
-                })
+        Each chapter's lines are stripped as a whole, like str.strip() on their
+        text. Text before the first H1 is dropped, as is the table of contents
+        (see _without_standalone_toc()). A document with no H1 at all comes back
+        as one (None, every line) pair. Only the chapter being collected is held.
+        """
+        title = None
+        body: List[str] = []
+        for line in self._without_standalone_toc(lines):
+            match = self.STANDALONE_H1.match(line)
+            if match:
+                if title is not None:
+                    yield title, self._stripped_lines(body)
+                title = match.group(1).strip()
+                body = []
+            else:
+                body.append(line)
+        if title is None:
+            yield None, body
+        else:
+            yield title, self._stripped_lines(body)
+
+    @staticmethod
+    def _stripped_lines(lines: List[str]) -> List[str]:
+        """``lines`` as ``'\\n'.join(lines).strip()`` would leave them, without the join."""
+        start, end = 0, len(lines)
+        while start < end and not lines[start].strip():
+            start += 1
+        while end > start and not lines[end - 1].strip():
+            end -= 1
+        lines = lines[start:end]
+        if lines:
+            lines[0] = lines[0].lstrip()
+            lines[-1] = lines[-1].rstrip()
+        return lines
 
-        # Generate DITA map
-        print(f"\n=== Generating DITA map ===")
-        map_content = self._generate_standalone_map(doc_title)
-        map_file = self.config.output_dir / self.config.maps_dir / f"{sanitize_id(md_file.stem)}.ditamap"
-        map_file.write_text(map_content, encoding='utf-8')
-        print(f"  Created map: {map_file.name}")
+    def _without_standalone_toc(self, lines: Iterator[str]) -> Iterator[str]:
+        """Drop each table of contents: from '## Table of Contents' through the next '---'.
 
-        print(f"\nStandalone conversion complete!")
-        print(f"   Topics: {len(self.converted_topics)}")
-        print(f"   Output: {self.config.output_dir}")
+        Matches the text, not the Markdown: the heading may end any line and the
+        rule is the first line after it ending in '---'; both need a newline
+        after them. Whatever preceded the heading on its line joins the line
+        after the rule. Without a closing rule nothing is removed, so the lines
+        after an unclosed heading are held until the end of the input.
+        """
+        toc = self.STANDALONE_TOC
+        prefix = ''
+        line = next(lines, None)
+        while line is not None:
+            following = next(lines, None)
+            if following is not None and line.endswith(toc):
+                held = []
+                candidate, after = following, None
+                while candidate is not None:
+                    after = next(lines, None)
+                    if after is not None and candidate.endswith('---'):
+                        break
+                    held.append(candidate)
+                    candidate = after
+                if candidate is not None:
+                    prefix += line[:-len(toc)]
+                    line = after
+                    continue
+                # No closing rule, so no table of contents here or anywhere after
+                yield prefix + line
+                yield from held
+                return
+            yield prefix + line
+            prefix = ''
+            line = following
 
     def _generate_standalone_map(self, title: str) -> str:
         """Generate a DITA map for a standalone document."""
@@ -2066,6 +3779,218 @@ class MarkdownToDITAConverter:
 </map>
 '''
 
+    def _render_diagrams(self):
+        """Render every diagram recorded while generating topics, then fix up failures.
+
+        Runs after the topics are written, so the network-bound rendering is one
+        phase that can be timed, parallelized or skipped on its own. Topics
+        already carry the href of a successful render; the rare failure is
+        patched in place afterwards, which keeps the output identical to
+        rendering each diagram as it was reached.
+        """
+        if not self.dita_gen.diagram_manifest:
+            return
+        print(f"\n=== Rendering {len(self.dita_gen.diagram_manifest)} Mermaid diagrams ===")
+        failed = self.dita_gen.render_diagrams()
+        report = self.config.diagram_report or self.config.output_dir.with_name(
+            f"{self.config.output_dir.name}-diagrams.json")
+        write_diagram_report(report, self.dita_gen.diagram_records,
+                             self.config.diagram_renderer, self.config.diagram_format)
+        print(f"  Diagram report: {report}")
+        if not failed:
+            return
+        for path in self.config.output_dir.rglob('*.dita'):
+            text = path.read_text(encoding='utf-8')
+            patched = text
+            for filename, error_name in failed.items():
+                # Every diagram href ends '.../images/<filename>"'; anchoring on the
+                # slash keeps one context from matching the tail of a longer one.
+                patched = patched.replace(f'/{filename}"', f'/{error_name}"')
+            if patched != text:
+                path.write_text(patched, encoding='utf-8')
+
+    def prefetch_diagrams(self) -> Dict[str, str]:
+        """Warm the render cache with every diagram a conversion would render.
+
+        Parses _includes/ and every guide the filters select (or the standalone
+        file) with MarkdownParser, and renders the Mermaid blocks the cache does
+        not already hold. No topics are generated and the output directory is
+        not touched, so a CI step can run this ahead of the real conversion.
+        Returns {filename: error_filename} for diagrams that failed to render.
+        """
+        print("=== Prefetching Mermaid diagrams ===")
+        _, failed = self._prefetch_from(self._diagram_source_files())
+        return failed
+
+    def _diagram_source_files(self) -> List[Path]:
+        """The Markdown files a conversion with this config reads diagrams from."""
+        if self.config.standalone_file:
+            return [self.config.standalone_file]
+        includes_dir = self.config.input_dir / '_includes'
+        files = sorted(includes_dir.rglob('*.md')) if includes_dir.exists() else []
+        return files + list(self._main_doc_files())
+
+    def export_diagram_pack(self, pack: Path) -> Dict[str, str]:
+        """Write every diagram this conversion needs to a portable zip.
+
+        Renders whatever the cache is missing first (as prefetch_diagrams()
+        does), then stores each render as diagrams/<hash>.<format> with a
+        manifest.json describing them, for import_diagram_pack() on a machine
+        that cannot reach the renderer. Diagrams that failed to render are left
+        out. Returns the render failures.
+        """
+        print("=== Exporting diagram pack ===")
+        sources, failed = self._prefetch_from(self._diagram_source_files())
+        fmt = self.config.diagram_format
+        entries = {}
+        for code in sources:
+            key = diagram_hash(code)
+            cached = self.dita_gen.diagram_cache.get(key, fmt)
+            if cached is not None and key not in entries:
+                entries[key] = cached.read_bytes()
+
+        manifest = {
+            'version': DIAGRAM_PACK_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'renderer': self.config.diagram_renderer,
+            'diagrams': [{'hash': key, 'format': fmt, 'file': f'diagrams/{key}.{fmt}',
+                          'bytes': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+                         for key, data in sorted(entries.items())],
+        }
+        pack.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pack.with_name(f'{pack.name}.{uuid.uuid4().hex}.tmp')
+        with zipfile.ZipFile(tmp, 'w') as zf:
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2) + '\n', zipfile.ZIP_DEFLATED)
+            for entry in manifest['diagrams']:
+                # PNGs are already deflated; SVG text still compresses well
+                method = zipfile.ZIP_STORED if fmt == 'png' else zipfile.ZIP_DEFLATED
+                zf.writestr(entry['file'], entries[entry['hash']], method)
+        os.replace(tmp, pack)
+        print(f"  Wrote {len(entries)} diagrams to {pack}")
+        return failed
+
+    def import_diagram_pack(self, pack: Path) -> int:
+        """Seed the render cache from a pack written by export_diagram_pack().
+
+        Every entry is checked against the manifest's checksum before it is
+        cached; entries the cache already holds are skipped. Raises ValueError
+        for a pack that is malformed or was made with a different renderer.
+        Returns the number of diagrams added.
+        """
+        print(f"=== Importing diagram pack {pack} ===")
+        cache = self.dita_gen.diagram_cache
+        added = 0
+        with zipfile.ZipFile(pack) as zf:
+            try:
+                manifest = json.loads(zf.read('manifest.json'))
+            except KeyError:
+                raise ValueError(f"{pack} has no manifest.json; not a diagram pack")
+            if not isinstance(manifest, dict) or not isinstance(manifest.get('diagrams', []), list):
+                raise ValueError(f"{pack} is corrupt: manifest.json is not a diagram pack manifest")
+            if manifest.get('version') != DIAGRAM_PACK_VERSION:
+                raise ValueError(f"{pack} is diagram pack version {manifest.get('version')}, "
+                                 f"expected {DIAGRAM_PACK_VERSION}")
+            if manifest.get('renderer') != self.config.diagram_renderer:
+                raise ValueError(f"{pack} holds {manifest.get('renderer')} renders, but this run uses "
+                                 f"the {self.config.diagram_renderer} renderer")
+            for entry in manifest.get('diagrams', []):
+                if not (isinstance(entry, dict)
+                        and all(isinstance(entry.get(k), str) for k in ('hash', 'format', 'file', 'sha256'))):
+                    raise ValueError(f"{pack} has a malformed entry: {entry!r}")
+                key, fmt = entry['hash'], entry['format']
+                # The hash becomes a cache filename, so it must be exactly that
+                if not re.fullmatch(r'[0-9a-f]{64}', key) or fmt not in DIAGRAM_FORMATS:
+                    raise ValueError(f"{pack} has a malformed entry: {entry['file']}")
+                if cache.get(key, fmt) is not None:
+                    continue
+                try:
+                    data = zf.read(entry['file'])
+                except KeyError:
+                    raise ValueError(f"{pack} is corrupt: {entry['file']} is missing")
+                if hashlib.sha256(data).hexdigest() != entry['sha256']:
+                    raise ValueError(f"{pack} is corrupt: checksum mismatch for {entry['file']}")
+                cache.put(key, data, fmt)
+                added += 1
+        print(f"  Added {added} of {len(manifest.get('diagrams', []))} diagrams to {cache.root}")
+        return added
+
+    # Site directories whose pages can carry Mermaid blocks (see --prerender-site)
+    SITE_DIAGRAM_DIRS = ('_includes', 'common', 'distributions')
+
+    def prerender_site(self) -> Dict[str, str]:
+        """Render the Jekyll site's Mermaid blocks to static images.
+
+        Every mermaid block in a page under SITE_DIAGRAM_DIRS is rendered (via
+        the cache, like prefetch_diagrams()) and copied to assets/diagrams/ in
+        the site as its shared_diagram_filename(). assets/diagrams/index.json
+        lists the diagrams that have an image, keyed by the first 16 hex digits
+        of diagram_hash(); _includes/mermaid-diagrams.html hashes each block the
+        same way in the browser and swaps in the image, falling back to
+        client-side Mermaid only for blocks missing from the index. Images of
+        diagrams no longer on the site are removed; one whose render failed this
+        time keeps its existing image, so a Kroki outage never unpublishes it.
+        Returns {filename: error_filename} for diagrams that failed to render.
+        """
+        site = self.config.input_dir
+        print(f"=== Pre-rendering Mermaid diagrams for the site in {site} ===")
+        files = sorted(md for name in self.SITE_DIAGRAM_DIRS if (site / name).is_dir()
+                       for md in (site / name).rglob('*.md'))
+        sources, failed = self._prefetch_from(files)
+
+        fmt = self.config.diagram_format
+        assets = site / 'assets' / 'diagrams'
+        assets.mkdir(parents=True, exist_ok=True)
+        index = {}
+        for code in sources:
+            key = diagram_hash(code)
+            if key[:16] in index:
+                continue
+            name = shared_diagram_filename(code, fmt)
+            target = assets / name
+            cached = self.dita_gen.diagram_cache.get(key, fmt)
+            if cached is None:
+                # Not rendered this run; the image is named by content, so one
+                # already published is still this diagram's
+                if target.exists():
+                    index[key[:16]] = name
+                continue
+            if not target.exists() or target.read_bytes() != cached.read_bytes():
+                shutil.copyfile(cached, target)
+            index[key[:16]] = name
+
+        stale = [p for p in assets.glob('diagram-*.*') if p.name not in index.values()]
+        for path in stale:
+            path.unlink()
+        (assets / 'index.json').write_text(
+            json.dumps({'format': fmt, 'diagrams': dict(sorted(index.items()))}, indent=2) + '\n',
+            encoding='utf-8')
+        print(f"  Wrote {len(index)} images to {assets} ({len(stale)} stale removed)")
+        return failed
+
+    def _prefetch_from(self, files: List[Path]) -> Tuple[List[str], Dict[str, str]]:
+        """Render the Mermaid blocks in ``files`` into the cache; returns (sources, failures)."""
+        sources = []
+        for md_file in files:
+            elements = self.dita_gen.parser.parse(md_file.read_text(encoding='utf-8'))
+            sources.extend(self._mermaid_sources(elements))
+        distinct = len({diagram_hash(code) for code in sources})
+        print(f"  Found {len(sources)} Mermaid blocks ({distinct} distinct) in {len(files)} files")
+
+        rendered, failed = self.dita_gen.prefetch_diagrams(sources)
+        print(f"  {distinct - rendered} already cached, {rendered - len(failed)} rendered, "
+              f"{len(failed)} failed")
+        return sources, failed
+
+    @classmethod
+    def _mermaid_sources(cls, elements: List[MarkdownElement]) -> List[str]:
+        """Mermaid code of every mermaid code block in ``elements``, at any depth."""
+        sources = []
+        for elem in elements:
+            if elem.type == 'code_block' and elem.language == 'mermaid':
+                sources.append(elem.content)
+            sources.extend(cls._mermaid_sources(elem.children))
+        return sources
+
     def _create_output_dirs(self):
         """Create output directory structure, cleaning existing files first."""
         import shutil
@@ -2226,15 +4151,8 @@ class MarkdownToDITAConverter:
         """
         registry = {}
 
-        include_re = re.compile(r'\{%\s*include\s+([^\s%}]+)\s*%\}')
-
-        def expand(text, depth=0):
-            """Inline include directives so their headings are visible to the scan."""
-            if depth > 3:
-                return text
-            def sub(m):
-                return expand(self.dita_gen._resolve_include(m.group(1)), depth + 1)
-            return include_re.sub(sub, text)
+        # Inline include directives so their headings are visible to the scan
+        expand = self.dita_gen.expand_include_text
 
         def headings(text):
             """Every ATX heading, as (level, title)."""
@@ -2327,8 +4245,8 @@ class MarkdownToDITAConverter:
         self._link_registry = registry
         return registry
 
-    def _convert_main_docs(self):
-        """Convert main documentation files to DITA topics."""
+    def _main_doc_files(self):
+        """Yield the guide files _convert_main_docs() converts, in its order."""
         # Find all QUICKSTART, GUI-QUICKSTART, and BEST-PRACTICES files
         for pattern in ['**/QUICKSTART.md', '**/GUI-QUICKSTART.md', '**/BEST-PRACTICES.md']:
             for md_file in self.config.input_dir.glob(pattern):
@@ -2341,7 +4259,12 @@ class MarkdownToDITAConverter:
                 if not self._should_convert_file(rel_path):
                     continue
 
-                self._convert_doc_file(md_file)
+                yield md_file
+
+    def _convert_main_docs(self):
+        """Convert main documentation files to DITA topics."""
+        for md_file in self._main_doc_files():
+            self._convert_doc_file(md_file)
 
         # Also convert standalone reference files from _includes that are linked from topics
         self._convert_reference_files()
@@ -2736,9 +4659,22 @@ Examples:
     # Organize output into subdirectories for easier selective import
     python convert_to_dita.py --inline-includes --section-maps --organize-sections
 
-    # Re-convert with existing images (skip re-downloading unchanged diagrams)
+    # Re-convert keeping the images directory (unchanged diagrams come from the render cache)
     python convert_to_dita.py --inline-includes --use-existing-images
 
+    # Render up to eight diagrams at a time
+    python convert_to_dita.py --inline-includes --diagram-jobs 8
+
+    # Warm the diagram cache (e.g. in CI) so the conversion itself renders nothing
+    python convert_to_dita.py --prefetch-diagrams --diagram-jobs 16
+
+    # Carry rendered diagrams to a runner that cannot reach Kroki
+    python convert_to_dita.py --inline-includes --export-diagram-pack diagrams.zip
+    python convert_to_dita.py --inline-includes --import-diagram-pack diagrams.zip
+
+    # Refresh the Jekyll site's pre-rendered diagrams (commit assets/diagrams/)
+    python convert_to_dita.py --prerender-site --diagram-format svg
+
     # Convert a standalone markdown file (e.g., PDF-extracted admin guide)
     python convert_to_dita.py --file pdf_conversion/purityfa_admin_guide_6105_formatted.md -o dita_admin_guide
 
@@ -2783,7 +4719,173 @@ Available protocols: iscsi, nvme-tcp, nfs, fc
     parser.add_argument(
         '--use-existing-images',
         action='store_true',
-        help='Keep existing images and only download missing ones (skips clearing images directory)'
+        help='Keep the images directory instead of clearing it. Diagrams are reused through the '
+             'render cache (see --diagram-cache), not from existing files: one missing from '
+             'the cache is rendered again'
+    )
+
+    parser.add_argument(
+        '--prefetch-diagrams',
+        action='store_true',
+        help='Only render uncached Mermaid diagrams into the render cache, without generating topics '
+             '(a warm-up step before the real conversion)'
+    )
+
+    parser.add_argument(
+        '--export-diagram-pack',
+        type=Path,
+        default=None,
+        metavar='ZIP',
+        help='Only render the diagrams this conversion needs and write them, with a manifest, '
+             'to ZIP for --import-diagram-pack on a machine without Kroki access'
+    )
+
+    parser.add_argument(
+        '--import-diagram-pack',
+        type=Path,
+        default=None,
+        metavar='ZIP',
+        help='Seed the diagram cache from a pack written by --export-diagram-pack before converting'
+    )
+
+    parser.add_argument(
+        '--prerender-site',
+        action='store_true',
+        help='Only render the Jekyll site\'s Mermaid blocks (_includes/, common/, distributions/ under '
+             '--input-dir) to assets/diagrams/, so pages show images instead of rendering client-side'
+    )
+
+    parser.add_argument(
+        '--optimize-images',
+        action='store_true',
+        help='After conversion, losslessly recompress every PNG in images/ and palettize flat-colour ones'
+    )
+
+    parser.add_argument(
+        '--diagram-jobs',
+        type=int,
+        default=4,
+        metavar='N',
+        help='Render up to N Mermaid diagrams concurrently, backing off while Kroki is slow or '
+             'failing (default: 4; 1 renders serially)'
+    )
+
+    parser.add_argument(
+        '--fixed-diagram-jobs',
+        action='store_true',
+        help='Keep --diagram-jobs renders in flight regardless of how Kroki responds'
+    )
+
+    parser.add_argument(
+        '--shared-diagrams',
+        action='store_true',
+        help='Name diagram images by content so identical diagrams share one file across guides'
+    )
+
+    parser.add_argument(
+        '--diagram-format',
+        choices=DIAGRAM_FORMATS,
+        default='png',
+        help='Image format to render Mermaid diagrams to; SVG files are smaller and scale cleanly (default: png)'
+    )
+
+    parser.add_argument(
+        '--diagram-cache',
+        type=Path,
+        default=None,
+        metavar='DIR',
+        help='Render cache shared across runs (default: $XDG_CACHE_HOME or ~/.cache, /quickstart-guides/diagrams)'
+    )
+
+    parser.add_argument(
+        '--parse-cache',
+        type=Path,
+        default=None,
+        metavar='FILE',
+        help='Parsed-Markdown cache reused across runs, so unchanged files are not parsed again '
+             '(default: $XDG_CACHE_HOME or ~/.cache, /quickstart-guides/parsed.json.gz)'
+    )
+
+    parser.add_argument(
+        '--no-parse-cache',
+        action='store_true',
+        help='Parse every file from scratch and leave the parse cache alone'
+    )
+
+    parser.add_argument(
+        '--diagram-cache-size',
+        type=int,
+        default=512,
+        metavar='MB',
+        help='Evict least recently used diagrams once the render cache exceeds MB megabytes (default: 512; 0 = no cap)'
+    )
+
+    parser.add_argument(
+        '--inline-cache-size',
+        type=int,
+        default=4096,
+        metavar='N',
+        help='Remember up to N rendered inline fragments (list items, table cells) for reuse '
+             'across guides (default: 4096; 0 = off)'
+    )
+
+    parser.add_argument(
+        '--diagram-retries',
+        type=int,
+        default=6,
+        metavar='N',
+        help='Attempts per diagram, with jittered exponential backoff (default: 6)'
+    )
+
+    parser.add_argument(
+        '--diagram-failure-budget',
+        type=int,
+        default=10,
+        metavar='N',
+        help='Stop rendering after N distinct diagrams have failed; the rest get -error.png placeholders. '
+             'Diagrams the renderer rejects as invalid do not count (default: 10)'
+    )
+
+    parser.add_argument(
+        '--diagram-deadline',
+        type=float,
+        default=0,
+        metavar='SECONDS',
+        help='Time allowed for all diagram rendering; diagrams not done by then get placeholders (default: no limit)'
+    )
+
+    parser.add_argument(
+        '--diagram-report',
+        type=Path,
+        default=None,
+        metavar='FILE',
+        help='Write per-diagram render telemetry (cache hits, bytes, latency, retries) as JSON to FILE '
+             '(default: <output-dir>-diagrams.json next to the output directory)'
+    )
+
+    parser.add_argument(
+        '--diagram-renderer',
+        choices=DIAGRAM_RENDERERS,
+        default='kroki',
+        help='Diagram backend: kroki (HTTP), command (--diagram-command), or stub '
+             '(placeholder images, for offline runs) (default: kroki)'
+    )
+
+    parser.add_argument(
+        '--diagram-command',
+        default='',
+        metavar='CMD',
+        help='Local render command for --diagram-renderer command; {input}, {output} and {format} '
+             'are substituted (e.g. "mmdc -i {input} -o {output}")'
+    )
+
+    parser.add_argument(
+        '--kroki-url',
+        action='append',
+        default=None,
+        metavar='URL',
+        help='Kroki server to render diagrams with; repeat to spread rendering over several '
+             '(default: $KROKI_URLS, comma-separated, or ' + KROKI_URL + ')'
     )
 
     parser.add_argument(
@@ -2847,6 +4949,35 @@ Available protocols: iscsi, nvme-tcp, nfs, fc
     args = parser.parse_args()
 
     # Validate inputs
+    if args.diagram_jobs < 1:
+        print("Error: --diagram-jobs must be at least 1", file=sys.stderr)
+        sys.exit(1)
+    if args.diagram_retries < 1:
+        print("Error: --diagram-retries must be at least 1", file=sys.stderr)
+        sys.exit(1)
+    if args.diagram_cache_size < 0:
+        print("Error: --diagram-cache-size cannot be negative", file=sys.stderr)
+        sys.exit(1)
+    if args.inline_cache_size < 0:
+        print("Error: --inline-cache-size cannot be negative", file=sys.stderr)
+        sys.exit(1)
+    if args.prefetch_diagrams and args.skip_diagrams:
+        print("Error: --prefetch-diagrams cannot be combined with --skip-diagrams", file=sys.stderr)
+        sys.exit(1)
+    if args.export_diagram_pack and (args.skip_diagrams or args.prefetch_diagrams or args.prerender_site):
+        print("Error: --export-diagram-pack cannot be combined with --skip-diagrams, --prefetch-diagrams "
+              "or --prerender-site", file=sys.stderr)
+        sys.exit(1)
+    if args.import_diagram_pack and not args.import_diagram_pack.is_file():
+        print(f"Error: Diagram pack does not exist: {args.import_diagram_pack}", file=sys.stderr)
+        sys.exit(1)
+    if args.prerender_site and (args.skip_diagrams or args.prefetch_diagrams or args.file):
+        print("Error: --prerender-site cannot be combined with --skip-diagrams, --prefetch-diagrams or --file",
+              file=sys.stderr)
+        sys.exit(1)
+    if args.diagram_renderer == 'command' and not args.diagram_command.strip():
+        print("Error: --diagram-renderer command needs --diagram-command", file=sys.stderr)
+        sys.exit(1)
     if args.file:
         if not args.file.exists():
             print(f"Error: File does not exist: {args.file}", file=sys.stderr)
@@ -2862,6 +4993,22 @@ Available protocols: iscsi, nvme-tcp, nfs, fc
         inline_includes=args.inline_includes,
         skip_diagrams=args.skip_diagrams,
         use_existing_images=args.use_existing_images,
+        optimize_images=args.optimize_images,
+        diagram_jobs=args.diagram_jobs,
+        diagram_adaptive=not args.fixed_diagram_jobs,
+        diagram_cache_dir=args.diagram_cache.resolve() if args.diagram_cache else None,
+        diagram_cache_size=args.diagram_cache_size * 1024 * 1024,
+        inline_cache_size=args.inline_cache_size,
+        parse_cache=None if args.no_parse_cache else (args.parse_cache or default_parse_cache_path()).resolve(),
+        shared_diagrams=args.shared_diagrams,
+        diagram_format=args.diagram_format,
+        diagram_retries=args.diagram_retries,
+        diagram_failure_budget=args.diagram_failure_budget,
+        diagram_deadline=args.diagram_deadline,
+        diagram_report=args.diagram_report.resolve() if args.diagram_report else None,
+        diagram_renderer=args.diagram_renderer,
+        diagram_command=args.diagram_command,
+        kroki_urls=args.kroki_url or parse_kroki_urls(os.environ.get('KROKI_URLS', '')) or [KROKI_URL],
         standalone_file=args.file.resolve() if args.file else None,
         single_task=args.single_task,
         distribution=args.distribution.lower(),
@@ -2873,14 +5020,39 @@ Available protocols: iscsi, nvme-tcp, nfs, fc
 
     # Run conversion
     converter = MarkdownToDITAConverter(config)
+    if args.import_diagram_pack:
+        try:
+            converter.import_diagram_pack(args.import_diagram_pack)
+        except (ValueError, zipfile.BadZipFile) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        print()
+    if args.export_diagram_pack:
+        failed = converter.export_diagram_pack(args.export_diagram_pack.resolve())
+        sys.exit(1 if failed else 0)
+    if args.prefetch_diagrams:
+        failed = converter.prefetch_diagrams()
+        sys.exit(1 if failed else 0)
+    if args.prerender_site:
+        failed = converter.prerender_site()
+        sys.exit(1 if failed else 0)
     converter.convert()
 
+    if config.optimize_images:
+        print("\n=== Optimizing images ===")
+        started = time.monotonic()
+        shrunk, before, after = optimize_images(config.output_dir / config.images_dir)
+        saved = before - after
+        print(f"  Shrank {shrunk} PNGs in {time.monotonic() - started:.1f}s, "
+              f"saving {saved / 1024:.0f} KiB of {before / 1024:.0f} KiB "
+              f"({100 * saved / before if before else 0:.1f}%)")
+
     # Print summary
     print(f"\nOutput Structure:")
     print(f"   {config.output_dir}/")
     print(f"   |-- {config.warehouse_dir}/    # Reusable content (warehouse topics)")
     print(f"   |-- {config.topics_dir}/       # Main documentation topics")
-    print(f"   |-- {config.images_dir}/       # Downloaded diagram images (PNG)")
+    print(f"   |-- {config.images_dir}/       # Downloaded diagram images ({config.diagram_format.upper()})")
     print(f"   `-- {config.maps_dir}/         # DITA navigation maps")
 
     print(f"\nImport Instructions for Heretto:")
@@ -2918,6 +5090,10 @@ def _zip_output(output_dir: Path, args) -> Path:
         parts.append('no-diagrams')
     if args.use_existing_images:
         parts.append('existing-images')
+    if args.shared_diagrams:
+        parts.append('shared-diagrams')
+    if args.diagram_format != 'png':
+        parts.append(f'{args.diagram_format}-diagrams')
     parts.append(date.today().isoformat())
 
     archive_name = '_'.join(parts) + '.zip'
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Fake Kroki Server for Offline Diagram Rendering
+
+A stdlib stand-in for the Kroki endpoints convert_to_dita.py uses, so the
+whole diagram pipeline (requests, retries, caching, batching) can be run and
+benchmarked on a machine with no Kroki and no network. Images are not real
+drawings: each is a framed placeholder whose size follows the diagram source,
+with a transparent background like Kroki's PNGs.
+
+Endpoints:
+    GET  /mermaid/png/<payload>   Source deflated + base64url-encoded, as get_kroki_path() sends it
+    GET  /mermaid/svg/<payload>
+    POST /mermaid/png             Raw source as the request body (also /mermaid/svg)
+    GET  /health
+
+Latency and failures can be injected to see how the converter copes with a
+slow or flaky renderer.
+
+Usage:
+    python scripts/fake_kroki.py --port 8000 --latency 0.2 --jitter 0.1 --failure-rate 0.05
+    python scripts/convert_to_dita.py --inline-includes --kroki-url http://127.0.0.1:8000
+"""
+
+import argparse
+import base64
+import http.server
+import random
+import socket
+import sys
+import threading
+import time
+import zlib
+from typing import Optional
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def decode_payload(payload: str) -> str:
+    """Invert Kroki's GET encoding: base64url of the zlib-deflated source."""
+    padded = payload + '=' * (-len(payload) % 4)
+    return zlib.decompress(base64.urlsafe_b64decode(padded)).decode('utf-8')
+
+
+def _chunk(chunk_type: bytes, payload: bytes) -> bytes:
+    return (len(payload).to_bytes(4, 'big') + chunk_type + payload
+            + zlib.crc32(chunk_type + payload).to_bytes(4, 'big'))
+
+
+def placeholder_size(source: str):
+    """Image size for a diagram: wider for longer lines, taller for more of them."""
+    lines = [line for line in source.splitlines() if line.strip()] or ['']
+    width = min(800, 40 + 8 * max(len(line) for line in lines))
+    height = min(600, 40 + 24 * len(lines))
+    return width, height
+
+
+def placeholder_png(source: str) -> bytes:
+    """An RGBA PNG: transparent inside a 2 px dark frame."""
+    width, height = placeholder_size(source)
+    edge = b'\x00' + b'\x30\x30\x30\xff' * width
+    middle = b'\x00' + b'\x30\x30\x30\xff' * 2 + b'\x00\x00\x00\x00' * (width - 4) + b'\x30\x30\x30\xff' * 2
+    raw = edge * 2 + middle * (height - 4) + edge * 2
+    ihdr = width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([8, 6, 0, 0, 0])
+    return (PNG_SIGNATURE + _chunk(b'IHDR', ihdr) + _chunk(b'IDAT', zlib.compress(raw))
+            + _chunk(b'IEND', b''))
+
+
+def placeholder_svg(source: str) -> bytes:
+    width, height = placeholder_size(source)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">'
+            f'<rect x="1" y="1" width="{width - 2}" height="{height - 2}" fill="none" '
+            f'stroke="#303030" stroke-width="2"/></svg>').encode('ascii')
+
+
+RENDERERS = {'png': ('image/png', placeholder_png), 'svg': ('image/svg+xml', placeholder_svg)}
+
+
+class FakeKrokiHandler(http.server.BaseHTTPRequestHandler):
+    """Serves placeholder renders with the server's latency and failure settings."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes; without this, Nagle plus
+        # delayed ACKs add ~40 ms to every keep-alive response.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, 'application/json', b'{"status":"pass"}')
+            return
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'mermaid':
+            self._send(404, 'text/plain', b'Not found')
+            return
+        try:
+            source = decode_payload(parts[2])
+        except (ValueError, zlib.error, UnicodeDecodeError):
+            self._send(400, 'text/plain', b'Unable to decode the source')
+            return
+        self._render(parts[1], source)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'mermaid':
+            self._send(404, 'text/plain', b'Not found')
+            return
+        self._render(parts[1], body.decode('utf-8', 'replace'))
+
+    def _render(self, fmt: str, source: str):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.rng.random() < server.failure_rate
+            delay = max(0.0, server.latency + server.rng.uniform(-server.jitter, server.jitter))
+        if delay:
+            time.sleep(delay)
+        if fmt not in RENDERERS:
+            self._send(400, 'text/plain', f'Unsupported output format: {fmt}'.encode())
+        elif not source.strip():
+            self._send(400, 'text/plain', b'Empty diagram source')
+        elif fail:
+            with server.lock:
+                server.failures += 1
+            self._send(server.failure_status, 'text/plain', b'Injected failure')
+        else:
+            content_type, render = RENDERERS[fmt]
+            self._send(200, content_type, render(source))
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+
+def make_server(host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                failure_rate: float = 0.0, failure_status: int = 503, seed: Optional[int] = None,
+                verbose: bool = False) -> http.server.ThreadingHTTPServer:
+    """Create (but do not start) a fake Kroki server; port 0 picks a free one.
+
+    The server's ``url``, ``requests`` and ``failures`` attributes report where
+    it listens and what it has answered; the injection settings can be changed
+    while it runs.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), FakeKrokiHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.rng = random.Random(seed)
+    server.latency, server.jitter = latency, jitter
+    server.failure_rate, server.failure_status = failure_rate, failure_status
+    server.verbose = verbose
+    server.requests = server.failures = 0
+    server.url = f'http://{host}:{server.server_address[1]}'
+    return server
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(
+        description='Serve placeholder Mermaid renders on a Kroki-compatible HTTP API.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help='Delay added to every render (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, metavar='SECONDS',
+                        help='Random spread applied to --latency, plus or minus (default: 0)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, metavar='FRACTION',
+                        help='Fraction of renders answered with --failure-status (default: 0)')
+    parser.add_argument('--failure-status', type=int, default=503, metavar='STATUS',
+                        help='HTTP status for injected failures (default: 503)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for reproducible jitter and failures')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    if not 0.0 <= args.failure_rate <= 1.0:
+        print("Error: --failure-rate must be between 0 and 1", file=sys.stderr)
+        sys.exit(1)
+
+    server = make_server(args.host, args.port, args.latency, args.jitter, args.failure_rate,
+                         args.failure_status, args.seed, args.verbose)
+    print(f"Fake Kroki listening on {server.url} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"\nAnswered {server.requests} renders ({server.failures} injected failures)")
+
+
+if __name__ == '__main__':
+    main()
@@ -20,23 +20,37 @@ is noticed rather than silently breaking a downstream expectation. There are
 currently none: every limitation this suite originally documented has been fixed.
 """
 
+import gzip
+import hashlib
+import http.server
 import importlib.util
+import io
+import json
+import os
+import random
 import re
+import shlex
 import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
 import urllib.parse
 import xml.etree.ElementTree as ET
+import zipfile
 import zlib
 import base64
+import contextlib
 from pathlib import Path
 
 REPO = Path(__file__).resolve().parent.parent
 FIXTURES = REPO / 'tests' / 'fixtures'
 STANDALONE = FIXTURES / 'standalone' / 'STANDALONE.md'
 SCRIPT = REPO / 'scripts' / 'convert_to_dita.py'
+FAKE_KROKI = REPO / 'scripts' / 'fake_kroki.py'
 
 # The canonical flag set from STYLEGUIDE.md / CLAUDE.md.
 CANONICAL = ('--inline-includes', '--section-maps', '--organize-sections')
@@ -54,6 +68,10 @@ _spec = importlib.util.spec_from_file_location('convert_to_dita', SCRIPT)
 conv = importlib.util.module_from_spec(_spec)
 _spec.loader.exec_module(conv)
 
+_spec = importlib.util.spec_from_file_location('fake_kroki', FAKE_KROKI)
+fake_kroki = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fake_kroki)
+
 
 # --------------------------------------------------------------------------
 # Converter runs (cached per flag combination, torn down at exit)
@@ -61,6 +79,16 @@ _spec.loader.exec_module(conv)
 
 _RUNS = {}
 _TMPDIRS = []
+_SAVED_ENV = {}
+
+
+def setUpModule():
+    # Converter runs keep a parse cache under $XDG_CACHE_HOME; give them a
+    # private one so the suite never reads or writes the user's
+    cache_home = Path(tempfile.mkdtemp(prefix='dita_xdg_'))
+    _TMPDIRS.append(cache_home)
+    _SAVED_ENV['XDG_CACHE_HOME'] = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = str(cache_home)
 
 
 def run_converter(*flags, source=None):
@@ -82,6 +110,11 @@ def run_converter(*flags, source=None):
 
 
 def tearDownModule():
+    for name, value in _SAVED_ENV.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
     for d in _TMPDIRS:
         shutil.rmtree(d, ignore_errors=True)
 
@@ -269,6 +302,54 @@ class TestInlineFormatting(unittest.TestCase):
         self.assertEqual(self.inline('**bold** and a stray **'),
                          '<b>bold</b> and a stray **')
 
+    def test_text_without_markup_is_returned_as_is(self):
+        text = self.inline('Set (queue depth) to 256 [recommended] & reboot')
+        self.assertEqual(text, 'Set (queue depth) to 256 [recommended] &amp; reboot')
+
+    def test_code_span_inside_link_text_and_emphasis(self):
+        self.assertEqual(self.inline('**`multipath -ll`** and [`lsblk`](https://x.io/y)'),
+                         '<b><codeph>multipath -ll</codeph></b> and <xref href="https://x.io/y" '
+                         'format="html" scope="external"><codeph>lsblk</codeph></xref>')
+
+
+
+class TestInlineMemo(unittest.TestCase):
+
+    def test_lru_evicts_the_least_recently_used_entry(self):
+        memo = conv.InlineMemo(max_entries=2)
+        memo.put('a', 'A')
+        memo.put('b', 'B')
+        self.assertEqual(memo.get('a'), 'A')
+        memo.put('c', 'C')
+        self.assertIsNone(memo.get('b'))
+        self.assertEqual(memo.get('c'), 'C')
+        self.assertEqual(memo.stats(), {'entries': 2, 'hits': 2, 'misses': 1, 'hit_rate': 0.6667})
+
+    def test_repeated_fragments_are_served_from_the_memo(self):
+        p = conv.MarkdownParser()
+        for _ in range(3):
+            self.assertEqual(p.convert_inline('**rw**,`hard`'), '<b>rw</b>,<codeph>hard</codeph>')
+        self.assertEqual((p.inline_memo.hits, p.inline_memo.misses), (2, 1))
+        p.convert_inline('no markup at all')
+        self.assertEqual(p.inline_memo.stats()['entries'], 1)
+
+    def test_link_renderings_are_keyed_by_topic_location(self):
+        g = conv.DITAGenerator(conv.ConversionConfig())
+        g.set_link_registry({'common/glossary.md': {'path': 'topics/common/c_glossary.dita'}})
+        g.set_source_context('distributions/rhel/nfs/QUICKSTART.md')
+        text = '[Glossary](../../../common/glossary.md)'
+        g.set_topic_subdir('')
+        self.assertIn('href="common/c_glossary.dita"', g.parser.convert_inline(text))
+        g.set_topic_subdir('rhel/nfs')
+        self.assertIn('href="../../common/c_glossary.dita"', g.parser.convert_inline(text))
+        g.set_link_registry({})
+        self.assertNotIn('c_glossary', g.parser.convert_inline(text))
+
+    def test_size_zero_turns_the_memo_off(self):
+        p = conv.MarkdownParser(inline_cache_size=0)
+        p.convert_inline('*x*')
+        self.assertEqual(p.convert_inline('*x*'), '<i>x</i>')
+        self.assertEqual(p.inline_memo.stats()['entries'], 0)
 
 # ==========================================================================
 # Unit tests: notes
@@ -468,6 +549,140 @@ class TestParser(unittest.TestCase):
         block = [e for e in els if e.type == 'code_block'][0]
         self.assertEqual(block.content, 'a:\n  b: 1')
 
+    def test_include_tag_inside_a_code_block_is_code(self):
+        els = self.p.parse('```liquid\n{% include note.md %}\n```\n{% include note.md %}\n')
+        self.assertEqual([e.type for e in els], ['code_block', 'include'])
+        self.assertEqual(els[0].content, '{% include note.md %}')
+
+    def test_paragraph_stops_at_block_starts_but_not_at_indented_markers(self):
+        els = self.p.parse('Text\n  # not a heading\n  > not a quote\n#### Heading\nMore\n- item\n')
+        self.assertEqual([e.type for e in els], ['paragraph', 'heading', 'paragraph', 'unordered_list'])
+        self.assertEqual(els[0].content, 'Text # not a heading > not a quote')
+
+    def test_unclosed_code_fence_runs_to_the_end(self):
+        els = self.p.parse('```bash\necho hi\n# still code')
+        self.assertEqual([e.type for e in els], ['code_block'])
+        self.assertEqual(els[0].content, 'echo hi\n# still code')
+
+    def test_iter_parse_streams_the_same_elements_as_parse(self):
+        md = ('---\ntitle: X\n---\n# Title\n{% raw %}\n```bash\necho {{x}}\n```\n'
+              '{% endraw %}\n- a\n  wrapped\n\n| A |\n|---|\n| 1 |\nText\n')
+        for source in (md, md.rstrip('\n'), ''):
+            with self.subTest(source=source):
+                streamed = list(self.p.iter_parse(io.StringIO(source)))
+                self.assertEqual([vars(e) for e in streamed], [vars(e) for e in self.p.parse(source)])
+
+    def test_iter_lines_splits_like_str_split(self):
+        for text in ('', 'a', 'a\n', 'a\n\nb', 'a\r\nb\n'):
+            with self.subTest(text=text):
+                self.assertEqual(list(conv.iter_lines(io.StringIO(text, newline=''))), text.split('\n'))
+
+
+
+class TestParseCache(unittest.TestCase):
+
+    MD = '# Title\n\n1. step\n   - sub\n\n| A | B |\n|---|---|\n| 1 | 2 |\n'
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='dita_parse_cache_'))
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.path = self.tmp / 'parsed.json.gz'
+
+    def parser(self):
+        p = conv.MarkdownParser()
+        p.parse_cache = conv.ParseCache(self.path)
+        p.parse_cache.load()
+        return p
+
+    def test_results_survive_a_round_trip_through_the_file(self):
+        first = self.parser()
+        expected = first.parse(self.MD)
+        first.parse_cache.save()
+        second = self.parser()
+        self.assertEqual(second.parse(self.MD), expected)
+        self.assertEqual(second.parse_cache.stats(), {'entries': 1, 'hits': 1, 'misses': 0})
+        self.assertEqual(expected, conv.MarkdownParser().parse(self.MD))
+
+    def test_hits_are_fresh_objects(self):
+        p = self.parser()
+        p.parse(self.MD)[0].content = 'changed'
+        self.assertEqual(p.parse(self.MD)[0].content, 'Title')
+
+    def test_a_file_from_another_converter_is_ignored(self):
+        p = self.parser()
+        p.parse(self.MD)
+        p.parse_cache.save()
+        stale = conv.ParseCache(self.path)
+        stale.fingerprint = '0' * 64
+        self.assertEqual(stale.load(), 0)
+
+    def test_unreadable_file_starts_empty(self):
+        self.path.write_bytes(b'not gzip')
+        self.assertEqual(conv.ParseCache(self.path).load(), 0)
+
+    def test_malformed_file_is_treated_as_a_miss(self):
+        stamp = {'version': conv.ParseCache.FORMAT_VERSION,
+                 'converter': conv.ParseCache(self.path).fingerprint}
+        for data in ([], 'x', dict(stamp, entries=[1]), dict(stamp, entries={'k': 5})):
+            with self.subTest(data=data):
+                with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+                    json.dump(data, f)
+                p = self.parser()
+                self.assertTrue(p.parse(self.MD))
+                p.parse_cache.save()
+                self.assertGreater(conv.ParseCache(self.path).load(), 0)
+
+    def test_cli_reuses_the_cache_on_the_next_run(self):
+        cmd = [sys.executable, str(SCRIPT), '-i', str(FIXTURES), '-o', str(self.tmp / 'out'),
+               '--skip-diagrams', '--parse-cache', str(self.path)]
+        first = subprocess.run(cmd, capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(first.returncode, 0, first.stdout + first.stderr)
+        second = subprocess.run(cmd, capture_output=True, text=True, cwd=str(REPO))
+        match = re.search(r'Parse cache: (\d+) of (\d+) documents', second.stdout)
+        self.assertIsNotNone(match, second.stdout)
+        self.assertEqual(match.group(1), match.group(2))
+
+
+class TestIncludeExpansion(unittest.TestCase):
+    """The per-run include caches and the cycle guard on every expansion path."""
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='dita_includes_'))
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        (self.tmp / '_includes').mkdir()
+        self.write('shared.md', '## Shared\n\nShared text.\n')
+        self.write('a.md', 'A text.\n\n{% include b.md %}\n')
+        self.write('b.md', '## B\n\nB text.\n\n{% include a.md %}\n')
+
+    def write(self, name, text):
+        (self.tmp / '_includes' / name).write_text(text, encoding='utf-8')
+
+    def generator(self):
+        config = conv.ConversionConfig(input_dir=self.tmp, output_dir=self.tmp / 'out', inline_includes=True)
+        return conv.DITAGenerator(config)
+
+    def test_each_include_is_parsed_once_per_run(self):
+        g = self.generator()
+        calls = []
+        parse = g.parser.parse
+        g.parser.parse = lambda text: calls.append(text) or parse(text)
+        for _ in range(3):
+            self.assertIn('Shared text.', g._inline_include_to_dita('shared.md'))
+            g._flatten_elements([conv.MarkdownElement(type='include', content='shared.md')])
+        self.assertEqual(len(calls), 1)
+
+    def test_cycles_are_cut_on_every_path(self):
+        g = self.generator()
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            dita = g._inline_include_to_dita('a.md')
+            flat = g._flatten_elements([conv.MarkdownElement(type='include', content='a.md')])
+            text = g.expand_include_text('{% include a.md %}')
+        self.assertEqual(dita.count('A text.'), 1)
+        self.assertIn('<!-- Include cycle: a.md -->', dita)
+        self.assertEqual([e.content for e in flat if e.type == 'paragraph'], ['A text.', 'B text.'])
+        self.assertEqual(text.count('A text.'), 1)
+        self.assertIn('Include cycle a.md -> b.md -> a.md', out.getvalue())
+
 
 class TestTaskBodyRouting(unittest.TestCase):
     """H2 routing rules in _elements_to_task_body, exercised on small inputs."""
@@ -581,6 +796,1122 @@ class TestImagePathDepth(unittest.TestCase):
         self.assertEqual(scope, 'local')
 
 
+class TestDiagramPool(unittest.TestCase):
+    """Diagrams are recorded during generation and rendered afterwards in one batch.
+
+    Concurrent rendering must emit exactly the markup a serial run does.
+    """
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='dita_pool_'))
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self._real = conv.download_mermaid_image
+        self.addCleanup(setattr, conv, 'download_mermaid_image', self._real)
+        self.active = self.peak = 0
+        self.lock = threading.Lock()
+
+    def fake_download(self, code, images_dir, context, num, *rest):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        if 'broken' in code:
+            return f'{context}-diagram-{num:02d}-error.png'
+        return f'{context}-diagram-{num:02d}.png'
+
+    def render(self, jobs, sources):
+        conv.download_mermaid_image = self.fake_download
+        g = conv.DITAGenerator(conv.ConversionConfig(output_dir=self.tmp, diagram_jobs=jobs))
+        g.set_source_context('distributions/rhel/iscsi/QUICKSTART.md')
+        g.set_topic_subdir('rhel/iscsi')
+        markup = [g._handle_mermaid_diagram(src) for src in sources]
+        return markup, g.render_diagrams()
+
+    def test_pool_markup_matches_serial_markup(self):
+        sources = [f'graph LR\n  A{i} --> B' for i in range(6)]
+        serial, _ = self.render(1, sources)
+        pooled, failed = self.render(4, sources)
+        self.assertEqual(pooled, serial)
+        self.assertEqual(failed, {})
+        self.assertIn('../../../images/rhel-iscsi-quickstart-diagram-06.png', pooled[-1])
+
+    def test_svg_format_names_and_references_svg_files(self):
+        config = conv.ConversionConfig(output_dir=self.tmp, diagram_format='svg')
+        g = conv.DITAGenerator(config)
+        g.set_source_context('distributions/rhel/iscsi/QUICKSTART.md')
+        g.set_topic_subdir('rhel/iscsi')
+        markup = g._handle_mermaid_diagram('graph LR\n  A --> B')
+        self.assertIn('href="../../../images/rhel-iscsi-quickstart-diagram-01.svg"', markup)
+        config.shared_diagrams = True
+        self.assertRegex(g._handle_mermaid_diagram('graph LR\n  A --> B'), r'diagram-[0-9a-f]{16}\.svg"')
+
+    def test_generation_records_jobs_without_rendering(self):
+        calls = []
+        conv.download_mermaid_image = lambda *a: calls.append(a) or a[5]
+        g = conv.DITAGenerator(conv.ConversionConfig(output_dir=self.tmp))
+        g.set_source_context('distributions/rhel/iscsi/QUICKSTART.md')
+        g._handle_mermaid_diagram('graph LR\n  A --> B')
+        g._handle_mermaid_diagram('graph LR\n  C --> D')
+        self.assertEqual(calls, [])
+        job = g.diagram_manifest[1]
+        self.assertEqual((job.source, job.context, job.number),
+                         ('graph LR\n  C --> D', 'rhel-iscsi-quickstart', 2))
+        self.assertEqual(job.target, self.tmp / 'images' / 'rhel-iscsi-quickstart-diagram-02.png')
+        g.render_diagrams()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(g.diagram_manifest, [])
+
+    def test_renders_overlap_up_to_the_job_limit(self):
+        self.render(3, [f'graph LR\n  A{i} --> B' for i in range(9)])
+        self.assertEqual(self.peak, 3)
+
+    def test_failures_are_reported_for_href_patching(self):
+        _, failed = self.render(4, ['graph LR\n  A --> B', 'broken'])
+        self.assertEqual(failed, {'rhel-iscsi-quickstart-diagram-02.png':
+                                  'rhel-iscsi-quickstart-diagram-02-error.png'})
+
+    def test_shared_mode_renders_each_distinct_diagram_once(self):
+        calls = []
+        conv.download_mermaid_image = lambda *a: calls.append(a[5]) or a[5]
+        g = conv.DITAGenerator(conv.ConversionConfig(output_dir=self.tmp, diagram_jobs=4,
+                                                     shared_diagrams=True))
+        name = conv.shared_diagram_filename('graph LR\n  A --> B')
+        g.set_source_context('distributions/rhel/iscsi/QUICKSTART.md')
+        g.set_topic_subdir('rhel/iscsi')
+        first = g._handle_mermaid_diagram('graph LR\n  A --> B')
+        g.set_source_context('distributions/suse/iscsi/QUICKSTART.md')
+        g.set_topic_subdir('')
+        second = g._handle_mermaid_diagram('graph LR\n    A --> B')
+        g.render_diagrams()
+        self.assertEqual(calls, [name])
+        # One file, referenced at the right depth from each topic
+        self.assertIn(f'href="../../../images/{name}"', first)
+        self.assertIn(f'href="../images/{name}"', second)
+
+    def test_written_hrefs_of_failed_renders_are_repointed(self):
+        conv.download_mermaid_image = self.fake_download
+        c = conv.MarkdownToDITAConverter(conv.ConversionConfig(output_dir=self.tmp))
+        c.dita_gen.set_source_context('distributions/rhel/iscsi/QUICKSTART.md')
+        topic = self.tmp / 't.dita'
+        topic.write_text(c.dita_gen._handle_mermaid_diagram('broken') + '\n'
+                         '<image href="../images/x-rhel-iscsi-quickstart-diagram-01.png"/>',
+                         encoding='utf-8')
+        c._render_diagrams()
+        text = topic.read_text(encoding='utf-8')
+        self.assertIn('../images/rhel-iscsi-quickstart-diagram-01-error.png"', text)
+        # A longer filename that merely ends the same way is left alone
+        self.assertIn('../images/x-rhel-iscsi-quickstart-diagram-01.png"', text)
+
+
+def make_png(width, height, color_type, pixels, extra_chunks=()):
+    """Encode a tiny 8-bit PNG; ``pixels`` is one bytes object per row."""
+    def chunk(kind, data):
+        return (len(data).to_bytes(4, 'big') + kind + data
+                + zlib.crc32(kind + data).to_bytes(4, 'big'))
+    ihdr = width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([8, color_type, 0, 0, 0])
+    raw = b''.join(b'\x00' + row for row in pixels)
+    return (conv.PNG_SIGNATURE + chunk(b'IHDR', ihdr)
+            + b''.join(chunk(kind, data) for kind, data in extra_chunks)
+            + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def fake_png(label: bytes) -> bytes:
+    """A valid opaque PNG unique to ``label``; flatten_png() passes it through as is."""
+    return make_png(10, 1, 2, [hashlib.sha256(label).digest()[:30]])
+
+
+class FakeResponse(io.BytesIO):
+    """Stands in for the urlopen() response object (a context manager)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class TestDiagramCache(unittest.TestCase):
+    """The render cache is keyed by diagram content, not by filename."""
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='dita_cache_'))
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.images = self.tmp / 'images'
+        self.images.mkdir()
+        self.cache = conv.DiagramCache(self.tmp / 'cache')
+        self.fetched = []
+        real = conv.urllib.request.urlopen
+        self.addCleanup(setattr, conv.urllib.request, 'urlopen', real)
+        conv.urllib.request.urlopen = self.fake_urlopen
+        self.addCleanup(setattr, conv.time, 'sleep', conv.time.sleep)
+        conv.time.sleep = lambda seconds: None
+
+    def fake_urlopen(self, req, timeout=None):
+        self.fetched.append(req.full_url)
+        return FakeResponse(fake_png(req.full_url.encode('ascii')))
+
+    def download(self, code, context='rhel-iscsi-quickstart', num=1, filename=None):
+        return conv.download_mermaid_image(code, self.images, context, num, self.cache, filename)
+
+    def test_normalization_ignores_layout_whitespace_only(self):
+        a = 'graph LR\n    A[Host]  -->  B[Array]\n\n'
+        b = 'graph LR\nA[Host] --> B[Array]'
+        self.assertEqual(conv.normalize_mermaid(a), b)
+        self.assertEqual(conv.diagram_hash(a), conv.diagram_hash(b))
+        self.assertNotEqual(conv.diagram_hash(b), conv.diagram_hash(b + '\nB --> C'))
+
+    def test_hit_skips_kroki_and_materializes_the_file(self):
+        self.download('graph LR\n  A --> B')
+        (self.images / 'rhel-iscsi-quickstart-diagram-01.png').unlink()
+        self.assertEqual(self.download('graph LR\n    A --> B'), 'rhel-iscsi-quickstart-diagram-01.png')
+        self.assertEqual(len(self.fetched), 1)
+        self.assertTrue((self.images / 'rhel-iscsi-quickstart-diagram-01.png').is_file())
+
+    def test_identical_diagram_in_another_guide_is_rendered_once(self):
+        self.download('graph LR\n  A --> B', context='rhel-iscsi-quickstart')
+        self.download('graph LR\n  A --> B', context='suse-iscsi-quickstart')
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual((self.images / 'rhel-iscsi-quickstart-diagram-01.png').read_bytes(),
+                         (self.images / 'suse-iscsi-quickstart-diagram-01.png').read_bytes())
+
+    def test_edited_diagram_replaces_the_stale_file(self):
+        self.download('graph LR\n  A --> B')
+        before = (self.images / 'rhel-iscsi-quickstart-diagram-01.png').read_bytes()
+        self.download('graph LR\n  A --> C')
+        after = (self.images / 'rhel-iscsi-quickstart-diagram-01.png').read_bytes()
+        self.assertEqual(len(self.fetched), 2)
+        self.assertNotEqual(before, after)
+
+    def test_shared_names_are_content_derived(self):
+        name = conv.shared_diagram_filename('graph LR\n  A --> B')
+        self.assertRegex(name, r'^diagram-[0-9a-f]{16}\.png$')
+        self.assertEqual(name, conv.shared_diagram_filename('graph LR\nA --> B\n'))
+        self.assertEqual(self.download('graph LR\n  A --> B', filename=name), name)
+        self.assertEqual(sorted(p.name for p in self.images.iterdir()), [name])
+        # What lands under the shared name is the render itself, through flatten_png()
+        self.assertEqual((self.images / name).read_bytes(), fake_png(self.fetched[0].encode('ascii')))
+
+    def test_default_cache_lives_outside_the_output_directory(self):
+        old = os.environ.get('XDG_CACHE_HOME')
+        self.addCleanup(lambda: os.environ.pop('XDG_CACHE_HOME') if old is None
+                        else os.environ.__setitem__('XDG_CACHE_HOME', old))
+        os.environ['XDG_CACHE_HOME'] = str(self.tmp / 'xdg')
+        self.assertEqual(conv.default_diagram_cache_dir(),
+                         self.tmp / 'xdg' / 'quickstart-guides' / 'diagrams')
+
+    def test_clean_build_materializes_from_the_cache(self):
+        out = self.tmp / 'dita_output'
+        config = conv.ConversionConfig(output_dir=out, diagram_cache_dir=self.cache.root)
+        self.cache.put(conv.diagram_hash('graph LR\n  A --> B'), b'PNG')
+        conv.MarkdownToDITAConverter(config)._create_output_dirs()
+        g = conv.DITAGenerator(config)
+        g.set_source_context('distributions/rhel/iscsi/QUICKSTART.md')
+        g._handle_mermaid_diagram('graph LR\n  A --> B')
+        self.assertEqual(g.render_diagrams(), {})
+        self.assertEqual(self.fetched, [])
+        self.assertEqual((out / 'images' / 'rhel-iscsi-quickstart-diagram-01.png').read_bytes(), b'PNG')
+
+    def test_prune_evicts_least_recently_used_entries(self):
+        earlier_run = conv.DiagramCache(self.tmp / 'lru')
+        for age, key in enumerate(['old', 'mid', 'new']):
+            path = earlier_run.put(key, b'x' * 10)
+            os.utime(path, (1000 + age, 1000 + age))
+        cache = conv.DiagramCache(earlier_run.root, max_bytes=20)
+        cache.get('old')   # a hit makes it the most recently used
+        self.assertEqual(cache.prune(), 1)
+        self.assertEqual(sorted(p.stem for p in cache.root.glob('*.png')), ['new', 'old'])
+        self.assertEqual(conv.DiagramCache(cache.root).prune(), 0)  # uncapped
+        self.assertEqual(conv.DiagramCache(cache.root, max_bytes=-1).prune(), 0)
+        self.assertEqual(len(list(cache.root.glob('*.png'))), 2)
+
+    def test_prune_keeps_what_this_run_rendered_even_over_the_cap(self):
+        cache = conv.DiagramCache(self.tmp / 'lru', max_bytes=10)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, b'x' * 10)
+        self.assertEqual(cache.prune(), 0)
+        self.assertEqual(len(list(cache.root.glob('*.png'))), 3)
+        # The next run, which has not used them, brings the cache back under its cap
+        self.assertEqual(conv.DiagramCache(cache.root, max_bytes=10).prune(), 2)
+
+
+class FakeClock:
+    """Monotonic clock the tests advance by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRenderRetries(unittest.TestCase):
+    """Backoff, fail-fast and run-wide limits in download_mermaid_image."""
+
+    PNG = fake_png(b'render')
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='dita_retry_'))
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.responses = []   # consumed per request: an exception or bytes
+        self.requests = 0
+        self.sleeps = []
+        self.clock = FakeClock()   # advanced by every sleep
+        for mod, name, fake in ((conv.urllib.request, 'urlopen', self.fake_urlopen),
+                                (conv.time, 'sleep', self.fake_sleep)):
+            self.addCleanup(setattr, mod, name, getattr(mod, name))
+            setattr(mod, name, fake)
+
+    def fake_sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.clock.now += seconds
+
+    def fake_urlopen(self, req, timeout=None):
+        self.requests += 1
+        outcome = self.responses.pop(0) if self.responses else self.PNG
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+    def http_error(self, status):
+        return conv.urllib.error.HTTPError('http://kroki', status, 'x', {}, None)
+
+    def download(self, policy=None, budget=None, num=1, code='graph LR\n  A --> B'):
+        return conv.download_mermaid_image(code, self.tmp, 'ctx', num, policy=policy, budget=budget)
+
+    def test_syntax_error_fails_immediately(self):
+        self.responses = [self.http_error(400)]
+        self.assertEqual(self.download(), 'ctx-diagram-01-error.png')
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_transient_errors_are_retried_with_capped_exponential_backoff(self):
+        self.responses = [self.http_error(503), self.http_error(429),
+                          conv.urllib.error.URLError('refused'), self.PNG]
+        policy = conv.RetryPolicy(max_attempts=5, base_delay=2, max_delay=5)
+        self.assertEqual(self.download(policy), 'ctx-diagram-01.png')
+        self.assertEqual(self.requests, 4)
+        self.assertEqual(len(self.sleeps), 3)
+        for attempt, wait in enumerate(self.sleeps, 1):
+            self.assertLessEqual(wait, min(5, 2 * 2 ** (attempt - 1)))
+
+    def test_record_counts_retries_and_bytes(self):
+        self.responses = [self.http_error(503), self.PNG]
+        record = conv.DiagramRecord(source_file='a.md', number=1, content_hash='h', filename='')
+        conv.download_mermaid_image('graph LR\n  A --> B', self.tmp, 'ctx', 1,
+                                    policy=conv.RetryPolicy(max_attempts=3), record=record)
+        self.assertEqual((record.cache, record.retries, record.size_bytes), ('miss', 1, len(self.PNG)))
+        self.assertEqual((self.tmp / 'ctx-diagram-01.png').stat().st_size, record.size_bytes)
+
+    def test_retryable_status_classification(self):
+        for status in (500, 502, 503, 504, 408, 429):
+            self.assertTrue(conv.is_retryable_status(status), status)
+        for status in (400, 401, 403, 404, 413, 414):
+            self.assertFalse(conv.is_retryable_status(status), status)
+
+    def test_spent_failure_budget_stops_further_requests(self):
+        budget = conv.RenderBudget(max_failures=1)
+        self.responses = [self.http_error(503)]
+        self.download(conv.RetryPolicy(max_attempts=1), budget)
+        self.assertEqual(self.download(budget=budget, num=2), 'ctx-diagram-02-error.png')
+        self.assertEqual(self.requests, 1)
+
+    def test_failures_count_once_per_diagram(self):
+        budget = conv.RenderBudget(max_failures=2)
+        self.responses = [self.http_error(503)] * 3
+        for num in (1, 2, 3):
+            self.download(conv.RetryPolicy(max_attempts=1), budget, num)
+        self.assertEqual(budget.failures, 1)
+        self.assertEqual(budget.admit(), ('', 0))
+
+    def test_rejected_diagram_is_not_resent_and_spends_no_budget(self):
+        budget = conv.RenderBudget(max_failures=1)
+        self.responses = [self.http_error(400)]
+        for num in range(1, 13):
+            self.assertEqual(self.download(budget=budget, num=num), f'ctx-diagram-{num:02d}-error.png')
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(budget.failures, 0)
+        # A valid diagram later in the run still renders
+        self.assertEqual(conv.download_mermaid_image('graph TD\n  C --> D', self.tmp, 'ctx', 13,
+                                                     budget=budget), 'ctx-diagram-13.png')
+
+    def test_breaker_opens_after_consecutive_errors_then_half_opens(self):
+        budget = conv.RenderBudget(breaker_threshold=2, breaker_cooldown=30, clock=self.clock)
+        for _ in range(2):
+            budget.record_error()
+        refusal, wait = budget.admit()
+        self.assertEqual(refusal, 'circuit breaker open')
+        self.assertGreater(wait, 0)
+        self.clock.now += 30
+        self.assertEqual(budget.admit(), ('', 0))              # the trial request
+        self.assertEqual(budget.admit()[0], 'circuit breaker open')
+        budget.record_success()
+        self.assertEqual(budget.admit(), ('', 0))
+
+    def test_short_outage_is_waited_out_without_spending_the_budget(self):
+        budget = conv.RenderBudget(max_failures=1, breaker_threshold=2, breaker_cooldown=30,
+                                   clock=self.clock)
+        self.responses = [conv.urllib.error.URLError('down')] * 3
+        policy = conv.RetryPolicy(max_attempts=4, base_delay=0)
+        results = [self.download(policy, budget, num, f'graph LR\n  A --> N{num}') for num in range(1, 11)]
+        self.assertEqual(results, [f'ctx-diagram-{num:02d}.png' for num in range(1, 11)])
+        # Two errors open the breaker, one trial fails, the next closes it again
+        self.assertEqual(self.requests, 13)
+        self.assertEqual(budget.failures, 0)
+        self.assertGreaterEqual(sum(self.sleeps), 60)
+
+    def test_breaker_gives_up_after_failed_trials_without_spending_the_budget(self):
+        budget = conv.RenderBudget(max_failures=1, breaker_threshold=2, breaker_cooldown=30,
+                                   breaker_trials=2, clock=self.clock)
+        self.responses = [conv.urllib.error.URLError('down')] * 100
+        policy = conv.RetryPolicy(max_attempts=10, base_delay=0)
+        self.assertEqual(self.download(policy, budget), 'ctx-diagram-01-error.png')
+        self.assertEqual(self.requests, 4)
+        self.assertEqual(budget.failures, 0)
+        self.assertEqual(budget.admit(), ('renderer unreachable after 2 trial requests', 0))
+        self.assertEqual(self.download(policy, budget, 2, 'graph TD\n  C'), 'ctx-diagram-02-error.png')
+        self.assertEqual(self.requests, 4)
+
+    def test_deadline_bounds_waits_and_refuses_new_work(self):
+        budget = conv.RenderBudget(deadline=10, clock=self.clock)
+        self.assertEqual(budget.clamp(60), 10)
+        self.clock.now += 10
+        self.assertEqual(self.download(budget=budget), 'ctx-diagram-01-error.png')
+        self.assertEqual(self.requests, 0)
+        self.assertEqual(budget.failures, 0)
+
+
+class KrokiStubHandler(http.server.BaseHTTPRequestHandler):
+    """Answers Kroki-style render requests with a fake_png() of the request."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes; without this, Nagle plus
+        # delayed ACKs add ~40 ms to every keep-alive response.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self._answer(fake_png(self.path.encode('ascii')))
+
+    def do_POST(self):
+        source = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.posted.append(source)
+        self._answer(fake_png(source))
+
+    def _answer(self, png):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            server.peers.add(self.client_address)
+        status = server.status
+        body = png if status == 200 else b'error'
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        if server.close_each:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_kroki_stub(status=200, close_each=False):
+    """Start a loopback Kroki stand-in; returns the server (stopped at cleanup)."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KrokiStubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.paths, server.posted, server.peers = [], [], set()
+    server.status, server.close_each = status, close_each
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+
+class TestKrokiClient(unittest.TestCase):
+    """Connection reuse in the pooled keep-alive client."""
+
+    def stub(self, **kwargs):
+        server = start_kroki_stub(**kwargs)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def client(self, server, pool_size=2):
+        client = conv.KrokiClient(server.url, pool_size=pool_size, timeout=5)
+        self.addCleanup(client.close)
+        return client
+
+    def test_sequential_requests_share_one_connection(self):
+        server = self.stub()
+        client = self.client(server)
+        for i in range(5):
+            self.assertEqual(client.get(f'/mermaid/png/{i}'), fake_png(f'/mermaid/png/{i}'.encode()))
+        self.assertEqual(client.connections_opened, 1)
+        self.assertEqual(len(server.peers), 1)
+
+    def test_concurrent_workers_never_exceed_the_pool(self):
+        server = self.stub()
+        client = self.client(server, pool_size=2)
+        with conv.ThreadPoolExecutor(max_workers=8) as pool:
+            bodies = list(pool.map(lambda i: client.get(f'/mermaid/png/{i}'), range(40)))
+        self.assertEqual(len(bodies), 40)
+        self.assertLessEqual(client.connections_opened, 2)
+
+    def test_server_closing_the_connection_is_not_an_error(self):
+        server = self.stub(close_each=True)
+        client = self.client(server)
+        for i in range(3):
+            client.get(f'/mermaid/png/{i}')
+        self.assertEqual(client.connections_opened, 3)
+
+    def test_errors_surface_as_urllib_exceptions(self):
+        client = self.client(self.stub(status=400))
+        with self.assertRaises(conv.urllib.error.HTTPError) as ctx:
+            client.get('/mermaid/png/x')
+        self.assertEqual(ctx.exception.code, 400)
+        # Nothing listens on the discard port of the loopback address
+        with self.assertRaises(conv.urllib.error.URLError):
+            conv.KrokiClient('http://127.0.0.1:9', timeout=1).get('/mermaid/png/x')
+
+    def test_download_renders_through_the_client(self):
+        server = self.stub()
+        tmp = Path(tempfile.mkdtemp(prefix='dita_client_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        client = self.client(server)
+        for num in (1, 2):
+            conv.download_mermaid_image(f'graph LR\n  A --> B{num}', tmp, 'ctx', num, client=client)
+        self.assertEqual(sorted(p.name for p in tmp.iterdir()),
+                         ['ctx-diagram-01.png', 'ctx-diagram-02.png'])
+        self.assertTrue(all(p.startswith('/mermaid/png/') for p in server.paths))
+        self.assertEqual(client.connections_opened, 1)
+
+    def test_svg_is_requested_and_written_unflattened(self):
+        server = self.stub()
+        tmp = Path(tempfile.mkdtemp(prefix='dita_svg_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        cache = conv.DiagramCache(tmp / 'cache')
+        code = 'graph LR\n  A --> B'
+
+        def flatten(data):
+            self.fail('SVG output was flattened')
+
+        name = conv.download_mermaid_image(code, tmp, 'ctx', 1, cache=cache, client=self.client(server),
+                                           flatten=flatten, fmt='svg')
+        self.assertEqual(name, 'ctx-diagram-01.svg')
+        self.assertTrue(server.paths[0].startswith('/mermaid/svg/'))
+        self.assertTrue((tmp / name).is_file())
+        # PNG and SVG renders of one diagram are separate cache entries
+        self.assertIsNotNone(cache.get(conv.diagram_hash(code), 'svg'))
+        self.assertIsNone(cache.get(conv.diagram_hash(code)))
+
+    def test_large_diagrams_are_posted(self):
+        server = self.stub()
+        client = self.client(server)
+        client.post_threshold = 200
+        small = 'graph LR\n  A --> B'
+        large = 'graph LR\n' + ''.join(f'  N{i}[Step {i}] --> N{i + 1}\n' for i in range(60))
+        self.assertEqual(client.render(small), fake_png(conv.get_kroki_path(small).encode()))
+        self.assertEqual(client.render(large), fake_png(large.strip().encode()))
+        self.assertEqual(server.paths[1], '/mermaid/png')
+        self.assertEqual(server.posted, [large.strip().encode()])
+        # Both requests travelled over the same keep-alive connection
+        self.assertEqual(client.connections_opened, 1)
+
+
+class TestKrokiBalancer(unittest.TestCase):
+    """Load spreading and health-based ejection across Kroki servers."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def stub(self, **kwargs):
+        server = start_kroki_stub(**kwargs)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def balancer(self, *servers):
+        balancer = conv.KrokiBalancer([s.url for s in servers], pool_size=2, timeout=5,
+                                      eject_seconds=30, clock=self.clock)
+        self.addCleanup(balancer.close)
+        return balancer
+
+    def test_renders_are_spread_over_every_server(self):
+        first, second = self.stub(), self.stub()
+        balancer = self.balancer(first, second)
+        for i in range(6):
+            balancer.render(f'graph LR\n  A --> B{i}')
+        self.assertEqual((len(first.paths), len(second.paths)), (3, 3))
+
+    def test_failing_server_is_ejected_until_it_passes_a_probe(self):
+        bad, good = self.stub(status=503), self.stub()
+        balancer = self.balancer(bad, good)
+        with self.assertRaises(conv.urllib.error.HTTPError):
+            balancer.render('graph LR\n  A --> B0')
+        for i in range(1, 5):
+            balancer.render(f'graph LR\n  A --> B{i}')
+        self.assertEqual(len(bad.paths), 1)
+        self.assertEqual(len(good.paths), 4)
+
+        # Once the ejection lapses, the server is probed before it gets work
+        bad.status = 200
+        self.clock.now += 31
+        for i in range(4):
+            balancer.render(f'graph LR\n  C --> D{i}')
+        self.assertEqual(bad.paths[1], '/health')
+        self.assertGreater(len(bad.paths), 2)
+
+    def test_bad_diagram_does_not_eject_the_server(self):
+        server = self.stub(status=400)
+        balancer = self.balancer(server, self.stub())
+        with self.assertRaises(conv.urllib.error.HTTPError):
+            balancer.render('graph LR\n  A -->')
+        self.assertFalse(balancer.endpoints[0].needs_probe)
+
+    def test_single_server_is_used_even_while_ejected(self):
+        server = self.stub(status=503)
+        balancer = self.balancer(server)
+        for _ in range(2):
+            with self.assertRaises(conv.urllib.error.HTTPError):
+                balancer.render('graph LR\n  A --> B')
+        self.assertEqual(len(server.paths), 2)
+
+    def test_kroki_urls_from_environment(self):
+        self.assertEqual(conv.parse_kroki_urls('http://a:8000, http://b:8000\nhttp://c:8000'),
+                         ['http://a:8000', 'http://b:8000', 'http://c:8000'])
+        self.assertEqual(conv.parse_kroki_urls(''), [])
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    """AIMD adjustment of the number of renders in flight."""
+
+    def succeed(self, limiter, times):
+        for _ in range(times):
+            limiter.release(limiter.acquire(), congested=False)
+
+    def test_grows_quickly_until_the_first_congestion(self):
+        limiter = conv.AdaptiveLimiter(maximum=16)
+        self.assertEqual(limiter.limit, 2)
+        self.succeed(limiter, 6)
+        self.assertEqual(limiter.limit, 8)
+        self.succeed(limiter, 50)
+        self.assertEqual(limiter.limit, 16)
+
+    def test_saturate_opens_the_cap_and_congestion_still_halves_it(self):
+        limiter = conv.AdaptiveLimiter(maximum=16)
+        limiter.saturate()
+        self.assertEqual(limiter.limit, 16)
+        limiter.release(limiter.acquire(), congested=True)
+        self.assertEqual(limiter.limit, 8)
+
+    def test_prefetch_starts_at_full_concurrency(self):
+        server = start_kroki_stub()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        tmp = Path(tempfile.mkdtemp(prefix='dita_prefetch_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        g = conv.DITAGenerator(conv.ConversionConfig(output_dir=tmp / 'out', diagram_cache_dir=tmp / 'cache',
+                                                     kroki_urls=[server.url], diagram_jobs=8))
+        limiter = g.renderer.limiter
+        self.assertEqual(limiter.limit, 2)
+        seen = []
+        acquire = limiter.acquire
+        limiter.acquire = lambda: (seen.append(limiter.limit), acquire())[1]
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(g.prefetch_diagrams(['graph LR\n  A --> B', 'graph LR\n  C --> D']), (2, {}))
+        self.assertEqual(seen, [8, 8])
+
+    def test_halves_on_congestion_then_grows_additively(self):
+        limiter = conv.AdaptiveLimiter(maximum=16, initial=8)
+        limiter.release(limiter.acquire(), congested=True)
+        self.assertEqual(limiter.limit, 4)
+        # About one step per limit's worth of successes
+        self.succeed(limiter, 4)
+        self.assertAlmostEqual(limiter.limit, 5, delta=0.2)
+
+    def test_one_overload_cuts_the_limit_once(self):
+        limiter = conv.AdaptiveLimiter(maximum=8, initial=8)
+        tokens = [limiter.acquire() for _ in range(8)]
+        self.assertEqual(limiter.in_flight, 8)
+        for token in tokens:
+            limiter.release(token, congested=True)
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(5):
+            limiter.release(limiter.acquire(), congested=True)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_acquire_blocks_at_the_limit(self):
+        limiter = conv.AdaptiveLimiter(maximum=4, initial=1)
+        token = limiter.acquire()
+        acquired = threading.Event()
+        threading.Thread(target=lambda: (limiter.acquire(), acquired.set()), daemon=True).start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(token, congested=False)
+        self.assertTrue(acquired.wait(5))
+
+    def test_balancer_reports_server_errors_as_congestion(self):
+        server = start_kroki_stub(status=503)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        limiter = conv.AdaptiveLimiter(maximum=8, initial=8)
+        balancer = conv.KrokiBalancer([server.url], timeout=5, limiter=limiter)
+        self.addCleanup(balancer.close)
+        with self.assertRaises(conv.urllib.error.HTTPError):
+            balancer.render('graph LR\n  A --> B')
+        self.assertEqual(limiter.limit, 4)
+        server.status = 400
+        with self.assertRaises(conv.urllib.error.HTTPError):
+            balancer.render('graph LR\n  A -->')
+        self.assertEqual(limiter.limit, 4.25)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+def have_module(name):
+    return importlib.util.find_spec(name) is not None
+
+
+class TestFlattenPng(unittest.TestCase):
+    """Header-only opacity check and compositing onto white."""
+
+    RGB = make_png(2, 1, 2, [b'\x10\x20\x30\x40\x50\x60'])
+    RGBA = make_png(2, 1, 6, [b'\x00\x00\x00\x00\x00\x00\x00\x80'])
+
+    def test_opacity_is_read_from_the_header(self):
+        self.assertTrue(conv.png_is_opaque(self.RGB))
+        self.assertFalse(conv.png_is_opaque(self.RGBA))
+        keyed = make_png(2, 1, 2, [b'\x00' * 6], [(b'tRNS', b'\x00\x00\x00\x00\x00\x00')])
+        self.assertFalse(conv.png_is_opaque(keyed))
+        self.assertFalse(conv.png_is_opaque(b'not a png'))
+
+    def test_opaque_images_are_returned_untouched(self):
+        self.assertIs(conv.flatten_png(self.RGB), self.RGB)
+
+    @unittest.skipIf(have_module('PIL'), 'Pillow is installed')
+    def test_without_pillow_images_pass_through(self):
+        self.assertIs(conv.flatten_png(self.RGBA), self.RGBA)
+
+    @unittest.skipUnless(have_module('PIL'), 'Pillow is not installed')
+    def test_transparency_is_composited_onto_white(self):
+        from PIL import Image
+        flat = Image.open(io.BytesIO(conv.flatten_png(self.RGBA)))
+        self.assertEqual(flat.mode, 'RGB')
+        self.assertEqual(flat.getpixel((0, 0)), (255, 255, 255))
+        self.assertEqual(flat.getpixel((1, 0)), (127, 127, 127))
+        # An alpha channel that is fully opaque needs no re-encode
+        solid = make_png(1, 1, 6, [b'\x10\x20\x30\xff'])
+        self.assertIs(conv.flatten_png(solid), solid)
+
+
+class TestOptimizeImages(unittest.TestCase):
+    """Lossless PNG shrinking after conversion."""
+
+    def stored_png(self, rows=64):
+        """A flat-colour PNG whose image data was deflated at level 0, split over two IDATs."""
+        png = make_png(64, rows, 2, [b'\xff\xff\xff' * 32 + b'\x20\x40\x80' * 32] * rows)
+        chunks = list(conv._png_chunks(png))
+        raw = zlib.decompress(b''.join(p for kind, p in chunks if kind == b'IDAT'))
+        stored = zlib.compress(raw, 0)
+        half = len(stored) // 2
+        return conv.PNG_SIGNATURE + b''.join([
+            conv._png_chunk(b'IHDR', chunks[0][1]),
+            conv._png_chunk(b'IDAT', stored[:half]),
+            conv._png_chunk(b'IDAT', stored[half:]),
+            conv._png_chunk(b'IEND', b'')]), raw
+
+    def test_recompression_keeps_pixels_and_chunks(self):
+        png, raw = self.stored_png()
+        smaller = conv.recompress_png(png)
+        self.assertLess(len(smaller), len(png) // 10)
+        chunks = list(conv._png_chunks(smaller))
+        self.assertEqual([kind for kind, _ in chunks], [b'IHDR', b'IDAT', b'IEND'])
+        self.assertEqual(chunks[0][1], list(conv._png_chunks(png))[0][1])
+        self.assertEqual(zlib.decompress(chunks[1][1]), raw)
+        # Already optimal input comes back as the same object
+        self.assertIs(conv.recompress_png(smaller), smaller)
+
+    def test_optimize_images_rewrites_only_what_shrinks(self):
+        tmp = Path(tempfile.mkdtemp(prefix='dita_optimize_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        # Worker processes cannot import a module loaded from a file path
+        self.addCleanup(setattr, conv, 'ProcessPoolExecutor', conv.ProcessPoolExecutor)
+        conv.ProcessPoolExecutor = conv.ThreadPoolExecutor
+        png, _ = self.stored_png()
+        (tmp / 'sub').mkdir()
+        (tmp / 'sub' / 'shot.png').write_bytes(png)
+        # Noise has too many colours to palettize and is already deflated as far
+        # as it goes, so nothing can shrink it
+        noise = random.Random(0).randbytes(32 * 32 * 3)
+        rows = [noise[i:i + 96] for i in range(0, len(noise), 96)]
+        incompressible = conv.recompress_png(make_png(32, 32, 2, rows))
+        (tmp / 'diagram.png').write_bytes(incompressible)
+        (tmp / 'notes.txt').write_bytes(b'not an image')
+        (tmp / 'broken.png').write_bytes(b'not a png either')
+
+        shrunk, before, after = conv.optimize_images(tmp)
+        self.assertEqual(shrunk, 1)
+        smallest = conv.optimize_png(png)   # palettized too when Pillow is installed
+        self.assertEqual(before - after, len(png) - len(smallest))
+        self.assertEqual((tmp / 'sub' / 'shot.png').read_bytes(), smallest)
+        self.assertEqual((tmp / 'diagram.png').read_bytes(), incompressible)
+        self.assertEqual((tmp / 'broken.png').read_bytes(), b'not a png either')
+        self.assertEqual(sorted(p.name for p in tmp.iterdir()), ['broken.png', 'diagram.png', 'notes.txt', 'sub'])
+
+    @unittest.skipUnless(have_module('PIL'), 'Pillow is not installed')
+    def test_flat_colour_images_are_palettized_losslessly(self):
+        from PIL import Image
+        png, _ = self.stored_png()
+        indexed = conv.palettize_png(png)
+        self.assertEqual(Image.open(io.BytesIO(indexed)).mode, 'P')
+        self.assertEqual(Image.open(io.BytesIO(indexed)).convert('RGB').tobytes(),
+                         Image.open(io.BytesIO(png)).convert('RGB').tobytes())
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Coalescing of identical renders that are in flight at the same time."""
+
+    def run_concurrently(self, flight, fn, callers=4):
+        """Call flight.do() from several threads; fn runs until all have joined."""
+        release = threading.Event()
+        calls = []
+
+        def leader_fn():
+            calls.append(1)
+            release.wait(5)
+            return fn()
+
+        def call():
+            try:
+                return flight.do('key', leader_fn)
+            except ValueError as e:
+                return e
+
+        with conv.ThreadPoolExecutor(max_workers=callers) as pool:
+            futures = [pool.submit(call) for _ in range(callers)]
+            deadline = time.monotonic() + 5
+            while flight.coalesced < callers - 1 and time.monotonic() < deadline:
+                time.sleep(0.005)
+            release.set()
+            return len(calls), [f.result() for f in futures]
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = conv.SingleFlight()
+        calls, results = self.run_concurrently(flight, lambda: b'png')
+        self.assertEqual(calls, 1)
+        self.assertEqual(results, [b'png'] * 4)
+        # Finished calls are forgotten; the next caller runs again
+        self.assertEqual(flight.do('key', lambda: b'again'), b'again')
+
+    def test_exception_reaches_every_caller(self):
+        def fail():
+            raise ValueError('boom')
+        calls, results = self.run_concurrently(conv.SingleFlight(), fail)
+        self.assertEqual(calls, 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    def test_same_diagram_in_several_files_is_rendered_once(self):
+        tmp = Path(tempfile.mkdtemp(prefix='dita_flight_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        flight = conv.SingleFlight()
+        release = threading.Event()
+
+        class Client:
+            timeout = 5
+            calls = 0
+
+            def render(self, code, timeout=None, fmt="png"):
+                Client.calls += 1
+                release.wait(5)
+                return fake_png(code.encode())
+
+        def download(num):
+            return conv.download_mermaid_image('graph LR\n  A --> B', tmp, f'guide{num}', 1,
+                                               client=Client(), flight=flight)
+
+        with conv.ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [pool.submit(download, n) for n in range(3)]
+            deadline = time.monotonic() + 5
+            while flight.coalesced < 2 and time.monotonic() < deadline:
+                time.sleep(0.005)
+            release.set()
+            names = sorted(f.result() for f in futures)
+        self.assertEqual(Client.calls, 1)
+        self.assertEqual(names, [f'guide{n}-diagram-01.png' for n in range(3)])
+        png = fake_png(b'graph LR\n  A --> B')
+        self.assertTrue(all((tmp / n).read_bytes() == png for n in names))
+
+
+class TestDiagramRenderers(unittest.TestCase):
+    """The non-HTTP backends behind ConversionConfig.diagram_renderer."""
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='dita_renderer_'))
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+
+    def test_stub_renders_placeholders_into_its_own_cache(self):
+        config = conv.ConversionConfig(output_dir=self.tmp / 'out', diagram_renderer='stub',
+                                       diagram_cache_dir=self.tmp / 'cache')
+        g = conv.DITAGenerator(config)
+        g.images_dir.mkdir(parents=True)
+        g.set_source_context('distributions/rhel/iscsi/QUICKSTART.md')
+        g._handle_mermaid_diagram('graph LR\n  A --> B')
+        self.assertEqual(g.render_diagrams(), {})
+        image = g.images_dir / 'rhel-iscsi-quickstart-diagram-01.png'
+        self.assertEqual(image.read_bytes(), conv.StubRenderer.PNG)
+        # Placeholders never end up where a real Kroki render would be found
+        self.assertEqual([p.parent.name for p in (self.tmp / 'cache').rglob('*.png')], ['stub'])
+
+    def test_command_renders_through_a_local_program(self):
+        copy = f'{shlex.quote(sys.executable)} -c "import shutil, sys; shutil.copy(*sys.argv[1:])"'
+        renderer = conv.CommandRenderer(copy + ' {input} {output}')
+        self.assertEqual(renderer.render('  graph LR\n  A --> B\n', fmt='svg'), b'graph LR\n  A --> B\n')
+        failing = conv.CommandRenderer(f'{shlex.quote(sys.executable)} -c "raise SystemExit(3)"')
+        with self.assertRaises(conv.DiagramRejected):
+            failing.render('graph LR\n  A --> B')
+
+    def test_rejected_diagram_is_not_retried(self):
+        class Rejecting(conv.DiagramRenderer):
+            calls = 0
+
+            def render(self, code, timeout=None, fmt='png'):
+                Rejecting.calls += 1
+                raise conv.DiagramRejected('syntax error')
+
+        name = conv.download_mermaid_image('graph LR\n  A -->', self.tmp, 'ctx', 1, client=Rejecting())
+        self.assertEqual(name, 'ctx-diagram-01-error.png')
+        self.assertEqual(Rejecting.calls, 1)
+
+
+class TestFakeKroki(unittest.TestCase):
+    """scripts/fake_kroki.py, and the full diagram pipeline run against it."""
+
+    def start(self, **kwargs):
+        server = fake_kroki.make_server(**kwargs)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def client(self, server):
+        client = conv.KrokiClient(server.url, timeout=5)
+        self.addCleanup(client.close)
+        return client
+
+    def test_answers_get_post_and_health_like_kroki(self):
+        server = self.start()
+        client = self.client(server)
+        small = 'graph LR\n  A --> B'
+        png = client.render(small)
+        self.assertTrue(png.startswith(conv.PNG_SIGNATURE))
+        self.assertFalse(conv.png_is_opaque(png))
+        client.post_threshold = 0
+        self.assertEqual(client.render(small), png)
+        self.assertTrue(client.render(small, fmt='svg').startswith(b'<svg'))
+        self.assertIn(b'pass', client.get('/health'))
+        with self.assertRaises(conv.urllib.error.HTTPError) as ctx:
+            client.get('/mermaid/png/not-deflate')
+        self.assertEqual(ctx.exception.code, 400)
+        self.assertEqual(server.requests, 3)  # Renders only
+
+    def test_injected_failures(self):
+        server = self.start(failure_rate=1.0, failure_status=429)
+        with self.assertRaises(conv.urllib.error.HTTPError) as ctx:
+            self.client(server).render('graph LR\n  A --> B')
+        self.assertEqual(ctx.exception.code, 429)
+        self.assertEqual(server.failures, 1)
+
+    def test_full_conversion_renders_every_diagram(self):
+        server = self.start()
+        tmp = Path(tempfile.mkdtemp(prefix='dita_fake_kroki_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        cmd = [sys.executable, str(SCRIPT), '-i', str(FIXTURES), '-o', str(tmp / 'out'),
+               '--kroki-url', server.url, '--diagram-cache', str(tmp / 'cache'), *CANONICAL]
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        images = sorted((tmp / 'out' / 'images').glob('*-diagram-*.png'))
+        self.assertTrue(images)
+        self.assertEqual(server.requests, len(images))
+        topics = ''.join(p.read_text(encoding='utf-8') for p in (tmp / 'out' / 'topics').rglob('*.dita'))
+        self.assertNotIn('-error.png', topics)
+        self.assertTrue(all(f'/{p.name}"' in topics for p in images))
+
+        # One telemetry record per diagram, written beside the output
+        report = json.loads((tmp / 'out-diagrams.json').read_text(encoding='utf-8'))
+        records = report['diagrams']
+        self.assertEqual(sorted(r['filename'] for r in records), [p.name for p in images])
+        self.assertEqual({r['cache'] for r in records}, {'miss'})
+        self.assertTrue(all(r['ok'] and r['size_bytes'] == (tmp / 'out' / 'images' / r['filename']).stat().st_size
+                            for r in records))
+        self.assertTrue(all(r['source_file'].startswith('distributions/testdist/') for r in records))
+        self.assertEqual(report['totals']['rendered'], len(images))
+
+        # A second build finds everything in the cache
+        shutil.rmtree(tmp / 'out')
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        self.assertEqual(server.requests, len(images))
+        report = json.loads((tmp / 'out-diagrams.json').read_text(encoding='utf-8'))
+        self.assertEqual(report['totals']['cache_hits'], len(images))
+
+    def test_prefetch_warms_the_cache_for_the_conversion(self):
+        server = self.start()
+        tmp = Path(tempfile.mkdtemp(prefix='dita_prefetch_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        cmd = [sys.executable, str(SCRIPT), '-i', str(FIXTURES), '-o', str(tmp / 'out'),
+               '--kroki-url', server.url, '--diagram-cache', str(tmp / 'cache'), *CANONICAL]
+        proc = subprocess.run(cmd + ['--prefetch-diagrams'], capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        self.assertFalse((tmp / 'out').exists())
+        prefetched = server.requests
+        self.assertEqual(len(list((tmp / 'cache').glob('*.png'))), prefetched)
+        self.assertGreater(prefetched, 0)
+
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        self.assertEqual(server.requests, prefetched)
+        self.assertTrue(list((tmp / 'out' / 'images').glob('*-diagram-*.png')))
+
+    def test_diagram_pack_seeds_an_offline_cache(self):
+        server = self.start()
+        tmp = Path(tempfile.mkdtemp(prefix='dita_pack_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        pack = tmp / 'diagrams.zip'
+        base = [sys.executable, str(SCRIPT), '-i', str(FIXTURES), '-o', str(tmp / 'out'), *CANONICAL]
+        proc = subprocess.run(base + ['--kroki-url', server.url, '--diagram-cache', str(tmp / 'online'),
+                                      '--export-diagram-pack', str(pack)],
+                              capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        with zipfile.ZipFile(pack) as zf:
+            manifest = json.loads(zf.read('manifest.json'))
+            self.assertEqual(len(manifest['diagrams']), server.requests)
+            self.assertEqual(len(zf.namelist()), server.requests + 1)
+        exported = server.requests
+
+        # The offline run points at a dead renderer; every diagram must come from the pack
+        proc = subprocess.run(base + ['--kroki-url', 'http://127.0.0.1:9', '--diagram-cache', str(tmp / 'offline'),
+                                      '--import-diagram-pack', str(pack)],
+                              capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        self.assertEqual(server.requests, exported)
+        self.assertEqual(len(list((tmp / 'offline').glob('*.png'))), exported)
+        self.assertNotIn('Failed', proc.stdout)
+
+    def test_tampered_diagram_pack_is_rejected(self):
+        tmp = Path(tempfile.mkdtemp(prefix='dita_pack_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        key = conv.diagram_hash('graph TD\n  A --> B')
+        manifest = {'version': conv.DIAGRAM_PACK_VERSION, 'renderer': 'kroki',
+                    'diagrams': [{'hash': key, 'format': 'png', 'file': f'diagrams/{key}.png',
+                                  'bytes': 3, 'sha256': hashlib.sha256(b'png').hexdigest()}]}
+        pack = tmp / 'diagrams.zip'
+        with zipfile.ZipFile(pack, 'w') as zf:
+            zf.writestr('manifest.json', json.dumps(manifest))
+            zf.writestr(f'diagrams/{key}.png', b'not the png')
+        proc = subprocess.run([sys.executable, str(SCRIPT), '-i', str(FIXTURES), '-o', str(tmp / 'out'),
+                               '--diagram-cache', str(tmp / 'cache'), '--import-diagram-pack', str(pack)],
+                              capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn('checksum mismatch', proc.stderr)
+        self.assertFalse((tmp / 'cache' / f'{key}.png').exists())
+
+    def test_diagram_pack_with_a_malformed_manifest_is_rejected(self):
+        tmp = Path(tempfile.mkdtemp(prefix='dita_pack_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        converter = conv.MarkdownToDITAConverter(conv.ConversionConfig(
+            output_dir=tmp / 'out', diagram_cache_dir=tmp / 'cache'))
+        for manifest in ([], 'pack', {'version': conv.DIAGRAM_PACK_VERSION, 'diagrams': {}}):
+            with self.subTest(manifest=manifest):
+                pack = tmp / 'diagrams.zip'
+                with zipfile.ZipFile(pack, 'w') as zf:
+                    zf.writestr('manifest.json', json.dumps(manifest))
+                with contextlib.redirect_stdout(io.StringIO()), \
+                        self.assertRaisesRegex(ValueError, 'is corrupt'):
+                    converter.import_diagram_pack(pack)
+
+    def test_diagram_pack_with_missing_member_or_keys_is_rejected(self):
+        tmp = Path(tempfile.mkdtemp(prefix='dita_pack_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        key = conv.diagram_hash('graph TD\n  A --> B')
+        entry = {'hash': key, 'format': 'png', 'file': f'diagrams/{key}.png',
+                 'sha256': hashlib.sha256(b'png').hexdigest()}
+        converter = conv.MarkdownToDITAConverter(conv.ConversionConfig(
+            output_dir=tmp / 'out', diagram_cache_dir=tmp / 'cache'))
+        for broken, message in ((entry, 'is missing'),
+                                ({k: v for k, v in entry.items() if k != 'sha256'}, 'malformed entry')):
+            with self.subTest(message=message):
+                pack = tmp / 'diagrams.zip'
+                with zipfile.ZipFile(pack, 'w') as zf:
+                    zf.writestr('manifest.json', json.dumps({'version': conv.DIAGRAM_PACK_VERSION,
+                                                             'renderer': 'kroki', 'diagrams': [broken]}))
+                with contextlib.redirect_stdout(io.StringIO()), \
+                        self.assertRaisesRegex(ValueError, message):
+                    converter.import_diagram_pack(pack)
+
+
+class TestSitePrerender(unittest.TestCase):
+    """--prerender-site and the page script that picks its images up."""
+
+    SITE_SCRIPT = REPO / '_includes' / 'mermaid-diagrams.html'
+
+    def test_prerender_writes_images_and_index(self):
+        server = fake_kroki.make_server()
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        tmp = Path(tempfile.mkdtemp(prefix='dita_site_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        site = tmp / 'site'
+        shutil.copytree(FIXTURES, site)
+        assets = site / 'assets' / 'diagrams'
+        assets.mkdir(parents=True)
+        (assets / 'diagram-0000000000000000.svg').write_text('<svg/>')
+
+        cmd = [sys.executable, str(SCRIPT), '-i', str(site), '--prerender-site', '--diagram-format', 'svg',
+               '--kroki-url', server.url, '--diagram-cache', str(tmp / 'cache')]
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+        index = json.loads((assets / 'index.json').read_text(encoding='utf-8'))
+        self.assertEqual(index['format'], 'svg')
+        self.assertTrue(index['diagrams'])
+        self.assertEqual(sorted(p.name for p in assets.glob('diagram-*')), sorted(index['diagrams'].values()))
+        for key, name in index['diagrams'].items():
+            self.assertEqual(name, f'diagram-{key}.svg')
+        self.assertFalse((tmp / 'out').exists())
+
+        # A second run whose renders all fail keeps the published images
+        server.failure_rate = 1.0
+        cmd[cmd.index('--diagram-cache') + 1] = str(tmp / 'empty-cache')
+        proc = subprocess.run(cmd + ['--diagram-retries', '1'], capture_output=True, text=True, cwd=str(REPO))
+        self.assertEqual(json.loads((assets / 'index.json').read_text(encoding='utf-8')), index)
+        self.assertEqual(sorted(p.name for p in assets.glob('diagram-*')), sorted(index['diagrams'].values()))
+
+    def test_page_script_only_fetches_an_index_the_build_found(self):
+        script = self.SITE_SCRIPT.read_text(encoding='utf-8')
+        self.assertIn('site.static_files | where: "path", "/assets/diagrams/index.json"', script)
+        self.assertIn('var hasIndex = {% if mermaid_index %}true{% else %}false{% endif %};', script)
+        self.assertIn('var index = (hasIndex && ', script)
+
+    @unittest.skipUnless(shutil.which('node'), 'node is not installed')
+    def test_page_script_hashes_blocks_like_the_converter(self):
+        script = self.SITE_SCRIPT.read_text(encoding='utf-8')
+        functions = re.findall(r'(    function (?:normalize|sha256)\(.*?\n    \})', script, re.DOTALL)
+        self.assertEqual(len(functions), 2)
+        sources = ['graph LR\n  A --> B\n', '  graph TD\r\n\r\n    A[Host]   -->|10 GbE| B{Switch}\t\n',
+                   'sequenceDiagram\n    participant H as Host \u2192 Array\n']
+        js = '\n'.join(functions) + f"""
+            Promise.all({json.dumps(sources)}.map(function (s) {{ return sha256(normalize(s)); }}))
+                .then(function (hashes) {{ console.log(JSON.stringify(hashes)); }});"""
+        proc = subprocess.run(['node', '-e', js], capture_output=True, text=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(json.loads(proc.stdout), [conv.diagram_hash(s) for s in sources])
+
+
 # ==========================================================================
 # Integration: QUICKSTART -> task topic (canonical flags)
 # ==========================================================================
@@ -1335,6 +2666,34 @@ class TestStandaloneChapters(ConverterCase):
     def test_standalone_map_root_declares_xml_lang(self):
         self.assertIn('<map xml:lang="en-US">', self.read('maps/standalone.ditamap'))
 
+    def test_chapters_are_cut_from_a_stream_without_the_table_of_contents(self):
+        md = ('Preamble\n## Table of Contents\n- [One](#one)\n---\n'
+              '# One\n\nBody\n```bash\n# Two\n```\n# Three \nEnd\n')
+        converter = conv.MarkdownToDITAConverter.__new__(conv.MarkdownToDITAConverter)
+        chapters = list(converter._standalone_chapters(conv.iter_lines(io.StringIO(md))))
+        # H1 lines split chapters even inside code blocks, as they always have
+        self.assertEqual(chapters, [('One', ['Body', '```bash']), ('Two', ['```']), ('Three', ['End'])])
+        self.assertEqual(list(converter._standalone_chapters(iter(['No', 'headings']))),
+                         [(None, ['No', 'headings'])])
+
+    def test_chapter_lines_are_stripped_like_their_text(self):
+        for lines in ([], ['', '  '], ['', '  a ', ' b  ', ' '], ['\tonly\t']):
+            with self.subTest(lines=lines):
+                stripped = conv.MarkdownToDITAConverter._stripped_lines(list(lines))
+                self.assertEqual('\n'.join(stripped), '\n'.join(lines).strip())
+
+    def test_streamed_chapters_bypass_the_parse_cache(self):
+        tmp = Path(tempfile.mkdtemp(prefix='dita_stream_'))
+        self.addCleanup(shutil.rmtree, tmp, True)
+        converter = conv.MarkdownToDITAConverter(conv.ConversionConfig(
+            output_dir=tmp / 'out', standalone_file=STANDALONE, skip_diagrams=True,
+            parse_cache=tmp / 'parsed.json.gz'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            converter.convert()
+        self.assertEqual(converter.dita_gen.parser.parse_cache.stats()['entries'], 0)
+        self.assertEqual({p.name for p in (tmp / 'out' / 'topics').glob('*.dita')},
+                         {'c_chapter_one.dita', 'c_chapter_two.dita'})
+
 
 class TestStandaloneSingleTask(ConverterCase):
 